@@ -0,0 +1,81 @@
+import os
+import logging
+import threading
+from file_lock import file_lock
+
+class AsinIndex:
+    """In-memory set of archived ASINs that follows appends made by other processes."""
+
+    def __init__(self, filepath = "asin_archive.txt"):
+        self.filepath = filepath
+        self.asins = set()
+        self.offset = 0
+        self._lock = threading.Lock()
+        with self._lock:
+            self._refresh()
+        logging.info(f"Loaded {len(self.asins)} ASINs from {filepath}")
+
+    def _refresh(self):
+        """Read only the lines appended since the last refresh."""
+        if not os.path.exists(self.filepath):
+            return
+
+        with open(self.filepath, "rb") as file:
+            file.seek(self.offset)
+            data = file.read()
+
+        # A line without its newline is still being written by another process
+        complete = data.rfind(b"\n") + 1
+        for line in data[:complete].splitlines():
+            asin = line.strip().decode("utf-8")
+            if asin:
+                self.asins.add(asin)
+        self.offset += complete
+
+    def __contains__(self, asin):
+        return asin in self.asins
+
+    def __len__(self):
+        return len(self.asins)
+
+    def contains(self, asin):
+        """Membership test that first picks up appends made by other processes."""
+        with self._lock:
+            self._refresh()
+            return asin in self.asins
+
+    def claim(self, asin):
+        """Archive the ASIN and return True, or return False if any process already archived it."""
+        if asin in self.asins:
+            logging.debug(f"{asin} already exists")
+            return False
+
+        with self._lock, file_lock(self.filepath):
+            self._refresh()
+            if asin in self.asins:
+                logging.debug(f"{asin} already exists")
+                return False
+
+            with open(self.filepath, "a+b") as file:
+                line = f"{asin}\n".encode("utf-8")
+                # Under the lock a line without its newline is left by a writer that crashed,
+                # end it first so the fragment does not swallow this ASIN
+                if file.seek(0, os.SEEK_END):
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) != b"\n":
+                        line = b"\n" + line
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+            self._refresh()
+            return True
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_asin_index(filepath = "asin_archive.txt"):
+    """Return the process-wide index for filepath, loading it on first use."""
+    with _indexes_lock:
+        if filepath not in _indexes:
+            _indexes[filepath] = AsinIndex(filepath)
+        return _indexes[filepath]
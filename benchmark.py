@@ -0,0 +1,399 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from collections import Counter, namedtuple
+from urllib.parse import urlsplit, parse_qs, quote_plus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:
+    # Windows has no getrusage, peak RSS is then left out
+    resource = None
+
+SCENARIOS = ("scrape", "full_extraction", "extract_warm", "delta", "direct_fetch")
+
+# Metrics where a larger value is better, everything else is better when smaller
+HIGHER_IS_BETTER = ("pages_per_s", "products_per_s", "images_per_s", "mb_per_s")
+
+MockConfig = namedtuple("MockConfig", [
+    "latency", "jitter", "error_rate", "products_per_page", "images_per_product",
+    "image_size", "product_size", "burst_every", "burst_length", "retry_after", "seed",
+    "html_pages", "captcha_every"
+], defaults=[0.05, 0.5, 0.0, 16, 4, 150 * 1024, 8 * 1024, 0, 0, "1", 0, 5, 0])
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Stand-in for the scrapingdog /amazon/search and /amazon/product endpoints, an image CDN
+    and Amazon's own /s search result pages for the direct-fetch mode."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type, headers = ()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(f"status_{status}", bytes_sent=len(body))
+
+    def do_GET(self):
+        server = self.server
+        config = server.config
+        parts = urlsplit(self.path)
+        params = {name: values[0] for name, values in parse_qs(parts.query).items()}
+
+        if parts.path == "/stats":
+            self.send_body(200, json.dumps(server.stats).encode("utf-8"), "application/json")
+            return
+
+        number = server.count("requests")
+        if config.burst_every and number % config.burst_every < config.burst_length:
+            self.send_body(429, b'{"error": "too many requests"}', "application/json", [("Retry-After", config.retry_after)])
+            return
+
+        if config.latency:
+            time.sleep(max(0.0, random.uniform(config.latency * (1 - config.jitter), config.latency * (1 + config.jitter))))
+        if random.random() < config.error_rate:
+            self.send_body(500, b'{"error": "mock failure"}', "application/json")
+            return
+
+        base = f"http://{self.headers['Host']}"
+        if parts.path == "/s":
+            if config.captcha_every and server.count("html_requests") % config.captcha_every == 0:
+                self.send_body(503, CAPTCHA_PAGE, "text/html")
+                return
+            page = search_html(config, base, params.get("k", ""), int(params.get("page", 1)))
+            self.send_body(200, page.encode("utf-8"), "text/html; charset=utf-8")
+        elif parts.path == "/amazon/search":
+            self.send_json(search_results(config, base, params.get("query", ""), int(params.get("page", 1))))
+        elif parts.path == "/amazon/product":
+            self.send_json(product_details(config, base, params.get("asin", "")))
+        elif parts.path.startswith("/images/"):
+            etag = f'"{hashlib.md5(parts.path.encode()).hexdigest()}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_body(304, b"", "image/jpeg", [("ETag", etag)])
+                return
+            self.send_body(200, image_bytes(server, parts.path), "image/jpeg", [("ETag", etag)])
+        else:
+            self.send_body(404, b"{}", "application/json")
+
+    def send_json(self, data):
+        self.send_body(200, json.dumps(data).encode("utf-8"), "application/json")
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config, address = ("127.0.0.1", 0)):
+        super().__init__(address, MockHandler)
+        self.config = config
+        self.stats = Counter()
+        random.seed(config.seed)
+        # One shared random body, every image only differs in its first bytes
+        self.image_body = random.Random(config.seed).randbytes(config.image_size)
+
+    def count(self, name, bytes_sent = 0):
+        # Counter updates are not atomic, but the stats are only indicative
+        self.stats[name] += 1
+        self.stats["bytes_sent"] += bytes_sent
+        return self.stats[name]
+
+def make_asin(query, page, index):
+    return "B" + hashlib.sha1(f"{query}:{page}:{index}".encode()).hexdigest()[:9].upper()
+
+def search_results(config, base, query, page):
+    results = []
+    for index in range(config.products_per_page):
+        asin = make_asin(query, page, index)
+        results.append({
+            "asin": asin, "title": f"{query} product {page}-{index}", "optimized_url": f"{base}/dp/{asin}",
+            "stars": round(3 + (index % 20) / 10, 1), "total_reviews": index * 37, "price": f"${10 + index}.99"
+        })
+    return {"results": results}
+
+def product_details(config, base, asin):
+    return {
+        "asin": asin,
+        "title": f"Mock product {asin}",
+        "customization_options": {},
+        "images": [f"{base}/images/{asin}_{number}.jpg" for number in range(config.images_per_product)],
+        # Filler so product payloads have a realistic size
+        "description": ("lorem ipsum " * (config.product_size // 12))[:config.product_size],
+    }
+
+CAPTCHA_PAGE = b"<html><head><title>Robot Check</title></head><body><form action='/errors/validateCaptcha'></form></body></html>"
+
+def result_card(base, asin, title, index):
+    """One search result in the markup scraper.py extracts."""
+    badge = ""
+    if index % 5 == 0:
+        badge = '<span data-component-type="s-status-badge-component" data-component-props=\'{"badgeType": "best-seller"}\'>Best Seller</span>'
+    return f"""<div data-asin="{asin}" data-component-type="s-search-result"><div data-dib-asin="{asin}" class="puis-card-container s-card-container">
+<img class="s-image" src="{base}/images/{asin}_0.jpg"/>{badge}
+<div class="a-section a-spacing-small puis-padding-left-small puis-padding-right-small">
+<h2 aria-label="{title}"><span>{title}</span></h2>
+<span aria-label="{3 + (index % 20) / 10:.1f} out of 5 stars"><i data-cy="reviews-ratings-slot"></i></span>
+<div data-csa-c-content-id="alf-customer-ratings-count-component"><span>({index * 37:,})</span></div>
+<span class="a-price"><span class="a-offscreen">${10 + index}.99</span></span>
+</div></div></div>"""
+
+def search_html(config, base, query, page):
+    """An Amazon search result page with a next page link on every page but the last of html_pages."""
+    cards = "".join(
+        result_card(base, make_asin(query, page, index), f"{query} product {page}-{index}", index)
+        for index in range(config.products_per_page)
+    )
+    if page < config.html_pages:
+        pagination = f'<a href="/s?k={quote_plus(query)}&amp;page={page + 1}" class="s-pagination-item s-pagination-next">Next</a>'
+    else:
+        pagination = '<span class="s-pagination-item s-pagination-next s-pagination-disabled">Next</span>'
+    return f"<html><head><title>Amazon.com : {query}</title></head><body><div class='s-main-slot'>{cards}</div>{pagination}</body></html>"
+
+def image_bytes(server, path):
+    return b"\xff\xd8\xff\xe0" + hashlib.sha256(path.encode()).digest() + server.image_body
+
+def serve_mock(config, port_queue):
+    """Process target: run the mock server and report its port."""
+    server = MockServer(config)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+def start_mock(config):
+    """Start the mock server in its own process, so it does not count towards the scraper's RSS."""
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_mock, args=(config, port_queue), daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+def histogram_summary(snapshot, name, **labels):
+    for entry in snapshot["histograms"].get(name, []):
+        if entry["labels"] == labels and entry["count"]:
+            return {"p50": entry["p50"], "p99": entry["p99"], "count": entry["count"]}
+    return None
+
+def counter_total(snapshot, name):
+    return sum(entry["value"] for entry in snapshot["counters"].get(name, []))
+
+def run_scenario(scenario, query, pages):
+    """Child process: run one scenario against the mock configured in the environment, return its measurements."""
+    logging.basicConfig(level=logging.WARNING)
+    if scenario == "direct_fetch":
+        return run_direct_fetch(query, pages)
+
+    # The import reads the environment set up by run_benchmark
+    import scraping_automator as automator
+    from metrics import metrics
+
+    automator.search_query = query
+    started = time.perf_counter()
+    if scenario == "scrape":
+        automator.run_jobs([automator.Job(query, "com", "us", range(1, pages + 1))])
+    elif scenario == "delta":
+        # Two delta runs with the response cache on, the second must still refetch its pages
+        automator.delta_mode = True
+        for _ in range(2):
+            automator.delta_state.clear()
+            automator.run_jobs([automator.Job(query, "com", "us", range(1, pages + 1))])
+    else:
+        automator.full_extraction()
+    elapsed = time.perf_counter() - started
+
+    snapshot = metrics.snapshot()
+    searched = histogram_summary(snapshot, "api_call_seconds", endpoint="search")
+    if scenario == "delta":
+        endpoint = f"{urlsplit(automator.SCRAPINGDOG_BASE_URL).netloc}/amazon/search"
+        fetched = sum(entry["value"] for entry in snapshot["counters"].get("http_responses_total", []) if entry["labels"]["endpoint"] == endpoint)
+        if searched is None or fetched < searched["count"]:
+            raise RuntimeError(f"Delta mode served search pages from the cache: {searched and searched['count']} searched, {fetched} fetched")
+    products = histogram_summary(snapshot, "api_call_seconds", endpoint="product")
+    images = automator.counter["total_image_urls"]
+    return {
+        "elapsed_s": elapsed,
+        "pages_per_s": (searched["count"] if searched else 0) / elapsed,
+        "products_per_s": (products["count"] if products else 0) / elapsed,
+        "images_per_s": images / elapsed,
+        "mb_per_s": counter_total(snapshot, "http_bytes_total") / 1024 / 1024 / elapsed,
+        "peak_rss_mb": peak_rss_mb(),
+        "retries": counter_total(snapshot, "http_retries_total"),
+        "latency": {
+            "search": searched,
+            "product": products,
+            "image": histogram_summary(snapshot, "image_download_seconds"),
+            "http": histogram_summary(snapshot, "http_request_seconds", endpoint=urlsplit(automator.SCRAPINGDOG_BASE_URL).netloc),
+        },
+    }
+
+def run_direct_fetch(query, pages):
+    """Child process: crawl the mock's HTML search pages with scraper.py, as the direct-fetch alternative to the API."""
+    import scraper
+    from metrics import metrics
+
+    queries = [f"{query} {number}" for number in range(scraper.DIRECT_WORKERS)]
+    started = time.perf_counter()
+    stats = scraper.crawl(queries, max_pages=pages, archive=False)
+    elapsed = time.perf_counter() - started
+
+    snapshot = metrics.snapshot()
+    return {
+        "elapsed_s": elapsed,
+        "pages_per_s": stats["pages"] / elapsed,
+        "products_per_s": stats["products"] / elapsed,
+        "images_per_s": 0.0,
+        "mb_per_s": counter_total(snapshot, "http_bytes_total") / 1024 / 1024 / elapsed,
+        "peak_rss_mb": peak_rss_mb(),
+        "retries": counter_total(snapshot, "http_retries_total"),
+        "latency": {"http": histogram_summary(snapshot, "http_request_seconds", endpoint=urlsplit(scraper.AMAZON_BASE_URL).netloc)},
+    }
+
+def run_benchmark(config, pages = 5, scenarios = SCENARIOS, workdir = None, query = "benchmark dress", verbose = False):
+    """Run the scenarios in order, each in a fresh process in the same work directory."""
+    workdir = workdir or tempfile.mkdtemp(prefix="scraper-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    process, base_url = start_mock(config)
+    env = {
+        **os.environ,
+        "scrapingdog_base_url": base_url,
+        "amazon_base_url": base_url,
+        "scrapingdog_api": "benchmark",
+        # Every run has to reach the mock, cached responses would measure the cache instead
+        "api_cache": "bypass",
+        "metrics_snapshot": "",
+    }
+
+    results = {"config": config._asdict(), "pages": pages, "scenarios": {}}
+    try:
+        for scenario in scenarios:
+            if scenario == "full_extraction":
+                # Cold extraction: nothing downloaded yet
+                for folder in ("Amazon", "image_store"):
+                    shutil.rmtree(os.path.join(workdir, folder), ignore_errors=True)
+
+            result_path = os.path.join(workdir, f"{scenario}.result.json")
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", scenario, "--query", query,
+                 "--pages", str(pages), "--result-path", result_path],
+                # Delta runs with the cache on, so serving its pages from the cache shows up as a failure
+                cwd=workdir, env={**env, "api_cache": "use"} if scenario == "delta" else env, check=True,
+                stdout=None if verbose else subprocess.DEVNULL,
+            )
+            with open(result_path, "r", encoding="utf-8") as file:
+                results["scenarios"][scenario] = json.load(file)
+            print(f"{scenario}: {format_result(results['scenarios'][scenario])}")
+    finally:
+        process.terminate()
+    results["workdir"] = workdir
+    return results
+
+def format_result(result):
+    latency = ", ".join(
+        f"{name} p50 {summary['p50'] * 1000:.0f}ms p99 {summary['p99'] * 1000:.0f}ms"
+        for name, summary in result["latency"].items() if summary
+    )
+    rss = f"{result['peak_rss_mb']:.0f}MB" if result["peak_rss_mb"] is not None else "n/a"
+    return (
+        f"{result['elapsed_s']:.2f}s, {result['pages_per_s']:.2f} pages/s, {result['products_per_s']:.2f} products/s, "
+        f"{result['images_per_s']:.2f} images/s, {result['mb_per_s']:.2f} MB/s, peak RSS {rss}; {latency}"
+    )
+
+def flatten(result):
+    """Comparable numbers of a scenario result, latencies as e.g. latency.image.p99."""
+    values = {name: value for name, value in result.items() if isinstance(value, (int, float))}
+    for name, summary in result["latency"].items():
+        if summary:
+            values[f"latency.{name}.p50"] = summary["p50"]
+            values[f"latency.{name}.p99"] = summary["p99"]
+    return values
+
+def compare(baseline, current, threshold = 0.1):
+    """Print the change of every metric against a baseline run, return the regressions beyond threshold."""
+    regressions = []
+    for scenario, result in current["scenarios"].items():
+        if scenario not in baseline["scenarios"]:
+            continue
+        before = flatten(baseline["scenarios"][scenario])
+        print(f"\n{scenario}")
+        for name, value in flatten(result).items():
+            old = before.get(name)
+            if old is None or value is None or not old:
+                continue
+            change = (value - old) / old
+            worse = -change if name in HIGHER_IS_BETTER else change
+            flag = "REGRESSION" if worse > threshold and name != "retries" else ""
+            print(f"  {name:24} {old:12.4f} -> {value:12.4f} ({change:+.1%}) {flag}")
+            if flag:
+                regressions.append((scenario, name, change))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the scraper against local mock API and image servers.")
+    parser.add_argument("--pages", type=int, default=5, help="Search pages to scrape")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--products-per-page", type=int, default=16)
+    parser.add_argument("--images-per-product", type=int, default=4)
+    parser.add_argument("--image-kb", type=int, default=150, help="Size of every mock image")
+    parser.add_argument("--product-kb", type=int, default=8, help="Size of every mock product payload")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Mean response latency")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Latency varies by +/- this fraction")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 500 responses")
+    parser.add_argument("--burst-every", type=int, default=0, help="Answer 429 to --burst-length of every N requests")
+    parser.add_argument("--burst-length", type=int, default=0)
+    parser.add_argument("--retry-after", default="1", help="Retry-After header of the 429 responses")
+    parser.add_argument("--captcha-every", type=int, default=0, help="Answer every Nth search page of the direct-fetch scenario with a captcha")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=None, help="Directory the scraper runs in (default: a new temp dir)")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="Results JSON of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change that counts as a regression")
+    parser.add_argument("--verbose", action="store_true", help="Show the scraper's own output")
+    # Internal: run a single scenario in this process
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--query", default="benchmark dress", help=argparse.SUPPRESS)
+    parser.add_argument("--result-path", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_scenario(args.child, args.query, args.pages)
+        with open(args.result_path, "w", encoding="utf-8") as file:
+            json.dump(result, file)
+        sys.exit(0)
+
+    config = MockConfig(
+        latency=args.latency_ms / 1000, jitter=args.jitter, error_rate=args.error_rate,
+        products_per_page=args.products_per_page, images_per_product=args.images_per_product,
+        image_size=args.image_kb * 1024, product_size=args.product_kb * 1024,
+        burst_every=args.burst_every, burst_length=args.burst_length, retry_after=args.retry_after, seed=args.seed,
+        html_pages=args.pages, captcha_every=args.captcha_every,
+    )
+    results = run_benchmark(config, args.pages, args.scenarios.split(","), args.workdir, verbose=args.verbose)
+
+    output = args.output or f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=4)
+    print(f"Results written to {output} (work directory: {results['workdir']})")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            regressions = compare(json.load(file), results, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions beyond {args.threshold:.0%}")
+            sys.exit(1)
@@ -0,0 +1,114 @@
+import os
+import json
+import math
+import time
+import logging
+import threading
+from file_lock import file_lock
+
+#scrapingdog credits per run and per day (0 is unlimited) and the credits a search/product call costs
+API_CREDIT_BUDGET = int(os.getenv("api_credit_budget", "0"))
+API_DAILY_BUDGET = int(os.getenv("api_daily_budget", "0"))
+SEARCH_CREDITS = int(os.getenv("search_credits", "1"))
+PRODUCT_CREDITS = int(os.getenv("product_credits", "1"))
+
+#Products per search page assumed by the dry-run plan until stored pages tell otherwise
+EXPECTED_PRODUCTS_PER_PAGE = int(os.getenv("expected_products_per_page", "20"))
+
+LEDGER_PATH = os.getenv("api_credit_ledger", "api_credits.json")
+
+class CreditBudget:
+    """Credits left for this run and for today, shared by every thread and process.
+
+    Calls reserve their credits before they are made, so the budget is never overrun.
+    The daily spend is kept per date in a small JSON ledger guarded by a file lock.
+    """
+
+    def __init__(self, run_limit = API_CREDIT_BUDGET, daily_limit = API_DAILY_BUDGET, ledger_path = LEDGER_PATH):
+        self.run_limit = run_limit
+        self.daily_limit = daily_limit
+        self.ledger_path = ledger_path
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    def _read_ledger(self):
+        if not os.path.exists(self.ledger_path):
+            return {}
+        with open(self.ledger_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def _update_daily(self, amount, check):
+        """Add amount to today's spend, unless check is set and it would pass the daily limit."""
+        today = time.strftime("%Y-%m-%d")
+        with file_lock(self.ledger_path):
+            ledger = self._read_ledger()
+            if check and ledger.get(today, 0) + amount > self.daily_limit:
+                return False
+            ledger[today] = ledger.get(today, 0) + amount
+            temp_path = f"{self.ledger_path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(ledger, file, indent=4)
+            os.replace(temp_path, self.ledger_path)
+            return True
+
+    def reserve(self, credits):
+        """Take credits from the budget, return False (taking nothing) if they do not fit."""
+        with self._lock:
+            if self.run_limit and self.spent + credits > self.run_limit:
+                return False
+            if self.daily_limit and not self._update_daily(credits, check=True):
+                return False
+            self.spent += credits
+            return True
+
+    def refund(self, credits):
+        """Give back reserved credits of a call that did not cost any, e.g. a cache hit."""
+        with self._lock:
+            self.spent -= credits
+            if self.daily_limit:
+                self._update_daily(-credits, check=False)
+
+    def remaining(self):
+        """Credits left, the smaller of the run and daily budgets (None when unlimited)."""
+        left = []
+        if self.run_limit:
+            left.append(self.run_limit - self.spent)
+        if self.daily_limit:
+            left.append(self.daily_limit - self._read_ledger().get(time.strftime("%Y-%m-%d"), 0))
+        return min(left) if left else None
+
+def open_budget(spec = None):
+    """Budget from a job file's {"run": N, "daily": N} falling back to the environment, None if unlimited."""
+    spec = spec or {}
+    run_limit = int(spec.get("run", API_CREDIT_BUDGET))
+    daily_limit = int(spec.get("daily", API_DAILY_BUDGET))
+    if not run_limit and not daily_limit:
+        return None
+    logging.info(f"API credit budget: {run_limit or 'unlimited'} per run, {daily_limit or 'unlimited'} per day")
+    return CreditBudget(run_limit, daily_limit)
+
+def parse_count(value):
+    """Numbers in search results may come as "1,234" or "4.5 out of 5 stars"."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        digits = value.replace(",", "").split()
+        try:
+            return float(digits[0]) if digits else 0.0
+        except ValueError:
+            return 0.0
+    return 0.0
+
+def product_priority(result):
+    """Value of fetching a search result: best seller and Amazon's choice badges, then reviews and stars."""
+    score = 0.0
+    if result.get("is_best_seller") or result.get("best_seller"):
+        score += 100
+    if result.get("is_amazon_choice") or result.get("amazon_choice"):
+        score += 50
+    if any(value for key, value in result.items() if "badge" in key.lower()):
+        score += 25
+    reviews = parse_count(result.get("total_reviews") or result.get("reviews") or result.get("ratings_total"))
+    score += 10 * math.log10(reviews + 1)
+    score += parse_count(result.get("stars") or result.get("rating"))
+    return score
@@ -0,0 +1,251 @@
+import io
+import os
+import sys
+import json
+import time
+import tarfile
+import logging
+import argparse
+import numpy as np
+from PIL import Image, ImageOps
+from concurrent.futures import ProcessPoolExecutor
+from segment_store import SegmentStore, open_store
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+#Export settings
+EXPORT_WORKERS = int(os.getenv("export_workers", str(os.cpu_count() or 1)))
+SHARD_SIZE = int(os.getenv("export_shard_size", "1000"))
+
+def iter_curated_images(source_dir):
+    """Yield (keyword, title, path) for every curated image, skipping any Trash folder."""
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames[:] = sorted(name for name in dirnames if name != "Trash" and not name.startswith('.'))
+        if os.path.basename(dirpath) != "Images":
+            continue
+
+        parts = os.path.relpath(dirpath, source_dir).split(os.sep)
+        keyword, title = parts[0], parts[-2]
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                yield keyword, title, os.path.join(dirpath, filename)
+
+def sample_key(path):
+    """WebDataset keys may not contain dots, so the key is the file name without extension."""
+    return os.path.splitext(os.path.basename(path))[0].replace(".", "-")
+
+def prepare_sample(path, max_side, memmap_size):
+    """Worker: return the JPEG bytes and the fixed size uint8 array of an image, None if it is unreadable.
+
+    JPEGs that need no downscaling are copied as they are without being decoded, anything else
+    (e.g. PNGs) is re-encoded so the .jpg member of the sample always holds a JPEG.
+    """
+    try:
+        with Image.open(path) as image:
+            downscale = max_side and max(image.size) > max_side
+            pixels = None
+            if image.format == "JPEG" and not downscale:
+                with open(path, "rb") as file:
+                    data = file.read()
+            else:
+                pixels = image.convert("RGB")
+                if downscale:
+                    pixels.thumbnail((max_side, max_side), Image.LANCZOS)
+                buffer = io.BytesIO()
+                pixels.save(buffer, format="JPEG", quality=90)
+                data = buffer.getvalue()
+
+            array = None
+            if memmap_size:
+                if pixels is None:
+                    # Only the memmap needs the pixels of a copied JPEG, let the decoder scale it down
+                    image.draft("RGB", (memmap_size, memmap_size))
+                    pixels = image.convert("RGB")
+                padded = ImageOps.pad(pixels, (memmap_size, memmap_size), color=(255, 255, 255))
+                array = np.asarray(padded, dtype=np.uint8)
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as err:
+        # Truncated or corrupt files are left out, the next export tries them again
+        logging.warning(f"Skipping unreadable image {path}: {err}")
+        return None
+    return data, array
+
+class ProductInfoLookup:
+    """Find the products_info record of an image by the product UUID in its file name."""
+
+    def __init__(self, info_dir = "products_info"):
+        self.info_dir = info_dir
+
+    def get(self, keyword, product_uuid):
+        folder = os.path.join(self.info_dir, keyword)
+        if SegmentStore.exists(folder):
+            info = open_store(folder).get(product_uuid)
+            if info is not None:
+                return info
+
+        legacy_path = os.path.join(folder, f"{product_uuid}.json")
+        if os.path.exists(legacy_path):
+            with open(legacy_path, "r") as file:
+                return json.load(file)
+        return None
+
+class DatasetExporter:
+    """Incremental export of the curated tree into tar shards and an optional uint8 memmap."""
+
+    def __init__(self, out_dir, shard_size = SHARD_SIZE, max_side = None, memmap_size = None):
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        self.max_side = max_side
+        self.memmap_size = memmap_size
+        os.makedirs(os.path.join(out_dir, "shards"), exist_ok=True)
+        self.manifest_path = os.path.join(out_dir, "manifest.ndjson")
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self):
+        manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    manifest[entry["path"]] = entry
+
+        removed_path = os.path.join(self.out_dir, "removed.ndjson")
+        if os.path.exists(removed_path):
+            with open(removed_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    removed = json.loads(line)
+                    if manifest.get(removed["path"], {}).get("shard") == removed["shard"]:
+                        del manifest[removed["path"]]
+        return manifest
+
+    def _next_shard(self):
+        shards = [name for name in os.listdir(os.path.join(self.out_dir, "shards")) if name.endswith(".tar")]
+        return len(shards)
+
+    def _memmap_path(self):
+        return os.path.join(self.out_dir, f"images_{self.memmap_size}x{self.memmap_size}.u8")
+
+    def export(self, source_dir, info_lookup = None, workers = EXPORT_WORKERS):
+        """Export the images that are new or changed since the last export, return their count."""
+        info_lookup = info_lookup or ProductInfoLookup()
+        pending = []
+        seen = set()
+        for keyword, title, path in iter_curated_images(source_dir):
+            stat = os.stat(path)
+            seen.add(path)
+            previous = self.manifest.get(path)
+            if previous and previous["mtime"] == stat.st_mtime and previous["size"] == stat.st_size:
+                continue
+            pending.append((keyword, title, path, stat))
+
+        self._record_removed([self.manifest.pop(path) for path in list(self.manifest) if path not in seen])
+        if not pending:
+            logging.info("Nothing new to export")
+            return 0
+
+        shard_number = self._next_shard()
+        memmap_file = open(self._memmap_path(), "ab") if self.memmap_size else None
+        memmap_rows = os.path.getsize(self._memmap_path()) // (self.memmap_size ** 2 * 3) if self.memmap_size else 0
+        manifest_file = open(self.manifest_path, "a", encoding="utf-8")
+        exported = 0
+
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for start in range(0, len(pending), self.shard_size):
+                    batch = pending[start:start + self.shard_size]
+                    shard_path = os.path.join(self.out_dir, "shards", f"shard-{shard_number:06d}.tar")
+                    temp_path = f"{shard_path}.tmp"
+                    results = pool.map(prepare_sample, [path for _, _, path, _ in batch],
+                                       [self.max_side] * len(batch), [self.memmap_size] * len(batch), chunksize=16)
+
+                    entries = []
+                    try:
+                        with tarfile.open(temp_path, "w") as tar:
+                            for (keyword, title, path, stat), sample in zip(batch, results):
+                                if sample is None:
+                                    continue
+                                data, array = sample
+                                key = sample_key(path)
+                                product_uuid = key.split("_")[0]
+                                metadata = {
+                                    "key": key, "keyword": keyword, "title": title, "source_path": path,
+                                    "product_uuid": product_uuid, "product": info_lookup.get(keyword, product_uuid)
+                                }
+                                add_tar_member(tar, f"{key}.jpg", data)
+                                add_tar_member(tar, f"{key}.json", json.dumps(metadata).encode("utf-8"))
+
+                                entry = {"path": path, "mtime": stat.st_mtime, "size": stat.st_size, "key": key, "shard": shard_number}
+                                if memmap_file:
+                                    memmap_file.write(array.tobytes())
+                                    entry["row"] = memmap_rows
+                                    memmap_rows += 1
+                                entries.append(entry)
+                    except BaseException:
+                        os.remove(temp_path)
+                        raise
+                    if not entries:
+                        os.remove(temp_path)
+                        continue
+
+                    # The shard only counts as exported once it is complete
+                    os.replace(temp_path, shard_path)
+                    if memmap_file:
+                        memmap_file.flush()
+                    # Changed images leave their earlier copy in an older shard, list those as stale
+                    self._record_removed([self.manifest[entry["path"]] for entry in entries if entry["path"] in self.manifest], "superseded")
+                    for entry in entries:
+                        manifest_file.write(json.dumps(entry) + "\n")
+                        self.manifest[entry["path"]] = entry
+                    manifest_file.flush()
+
+                    exported += len(entries)
+                    logging.info(f"Wrote {shard_path} with {len(entries)} samples")
+                    print(f"Wrote {shard_path} with {len(entries)} samples")
+                    shard_number += 1
+        finally:
+            manifest_file.close()
+            if memmap_file:
+                memmap_file.close()
+
+        if exported < len(pending):
+            logging.warning(f"Skipped {len(pending) - exported} unreadable images")
+        return exported
+
+    def _record_removed(self, entries, reason = "removed"):
+        """Keep a list of exported samples that were since trashed or superseded by a newer copy.
+
+        Every line names the shard (and memmap row) of a stale sample, so loaders can skip it.
+        """
+        if not entries:
+            return
+        with open(os.path.join(self.out_dir, "removed.ndjson"), "a", encoding="utf-8") as file:
+            for entry in entries:
+                file.write(json.dumps({**entry, reason: time.time()}) + "\n")
+
+def add_tar_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+def load_memmap(out_dir, size):
+    """Open an exported memmap as an (N, size, size, 3) uint8 array."""
+    array = np.memmap(os.path.join(out_dir, f"images_{size}x{size}.u8"), dtype=np.uint8, mode="r")
+    return array.reshape(-1, size, size, 3)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export curated images into training-ready shards.")
+    parser.add_argument("--source", default="Amazon/Women", help="Curated image tree")
+    parser.add_argument("--out", default="dataset_export", help="Output directory")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE, help="Samples per tar shard")
+    parser.add_argument("--max-side", type=int, default=None, help="Downscale JPEGs in the shards to this size")
+    parser.add_argument("--memmap-size", type=int, default=None, help="Also write a fixed size uint8 memmap")
+    parser.add_argument("--workers", type=int, default=EXPORT_WORKERS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    exporter = DatasetExporter(args.out, args.shard_size, args.max_side, args.memmap_size)
+    exported = exporter.export(args.source, workers=args.workers)
+    print(f"Exported {exported} images to {args.out}")
@@ -0,0 +1,40 @@
+import os
+import threading
+from contextlib import contextmanager
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+# Locks held by this process, so threads queue up before taking the OS level lock
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+def _thread_lock(lock_path):
+    with _thread_locks_guard:
+        return _thread_locks.setdefault(os.path.abspath(lock_path), threading.Lock())
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on {path}.lock across threads and processes."""
+    lock_path = f"{path}.lock"
+    directory = os.path.dirname(lock_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with _thread_lock(lock_path):
+        with open(lock_path, "a+") as lock_file:
+            if os.name == 'nt':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if os.name == 'nt':
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
@@ -4,6 +4,7 @@ import os
 import shutil
 import re
 from datetime import datetime, timedelta
+from near_duplicates import find_near_duplicates
 
 # Define the base directory structure
 BASE_DIR = "Amazon/Women"
@@ -320,6 +321,21 @@ def select_all_images(request: gr.Request):
     image_names = [f"{os.path.basename(img)} ({index + 1})" for index, img in enumerate(current_images)]
     return gr.update(value=image_names)
 
+# Function to select near-duplicate images, keeping the first image of every group
+def select_near_duplicates(request: gr.Request):
+    username = str(request.username)
+    current_images = USER_STATE[username]["current_images"]
+    if not current_images:
+        return gr.update(value=[])
+
+    groups = find_near_duplicates(os.path.dirname(current_images[0]))
+    duplicates = {os.path.normpath(img) for group in groups for img in group[1:]}
+    image_names = [
+        f"{os.path.basename(img)} ({index + 1})" for index, img in enumerate(current_images)
+        if os.path.normpath(img) in duplicates
+    ]
+    return gr.update(value=image_names)
+
 # Function to deselect all images
 def deselect_all_images():
     return gr.update(value=[])
@@ -433,6 +449,7 @@ with gr.Blocks() as app:
                 # Select/Deselect buttons
                 select_all_button = gr.Button("Select All")
                 deselect_all_button = gr.Button("Deselect All")
+                select_duplicates_button = gr.Button("Select Near-Duplicates")
                 keep_selected_only_button = gr.Button("Keep selected only")
 
         delete_button = gr.Button("Move to Trash")
@@ -499,6 +516,12 @@ with gr.Blocks() as app:
             outputs=image_checkboxes
         )
 
+        select_duplicates_button.click(
+            fn=select_near_duplicates,
+            inputs=[],
+            outputs=image_checkboxes
+        )
+
         # Select/Deselect all images in Trash
         select_all_trash_button.click(
             fn=select_all_trash,
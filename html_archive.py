@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import time
+import zlib
+import logging
+import argparse
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from file_lock import file_lock
+from product_records import RecordWriter
+
+#Raw search pages are kept here so the extractors can be re-run without fetching again
+HTML_ARCHIVE_DIR = os.getenv("html_archive_dir", "html_archive")
+
+#Start a new archive file once the current one grows past this size
+ARCHIVE_SEGMENT_BYTES = int(float(os.getenv("html_archive_segment_mb", "256")) * 1024 * 1024)
+
+#Re-parse settings: worker processes and pages handed to a worker at a time
+REPARSE_WORKERS = int(os.getenv("reparse_workers", str(os.cpu_count() or 1)))
+REPARSE_CHUNK = int(os.getenv("reparse_chunk", "32"))
+
+class HtmlArchive:
+    """Append-only archive of raw search pages, zlib compressed, with a (query, page, timestamp) index.
+
+    Every fetch is kept, also repeated fetches of the same page, as one compressed frame
+    appended to archive-NNNNN.bin. index.ndjson has one line per frame so pages can be
+    selected and read back without decompressing anything else.
+    """
+
+    def __init__(self, directory = HTML_ARCHIVE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.ndjson")
+        self._lock = threading.Lock()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"archive-{segment:05d}.bin")
+
+    def _last_segment(self):
+        segments = [int(name[8:13]) for name in os.listdir(self.directory) if name.startswith("archive-") and name.endswith(".bin")]
+        return max(segments, default=1)
+
+    def put(self, query, page, html, url = None, timestamp = None):
+        """Store the raw bytes (or text) of a fetched page and return its index entry."""
+        if isinstance(html, str):
+            html = html.encode("utf-8")
+        frame = zlib.compress(html, 6)
+
+        with self._lock, file_lock(self.index_path):
+            segment = self._last_segment()
+            path = self._segment_path(segment)
+            if os.path.exists(path) and os.path.getsize(path) + len(frame) > ARCHIVE_SEGMENT_BYTES:
+                segment += 1
+                path = self._segment_path(segment)
+
+            with open(path, "ab") as file:
+                offset = file.tell()
+                file.write(frame)
+
+            entry = {
+                "query": query, "page": page, "timestamp": timestamp or time.time(), "url": url,
+                "segment": segment, "offset": offset, "length": len(frame), "size": len(html)
+            }
+            with open(self.index_path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry) + "\n")
+        return entry
+
+    def entries(self, query = None, since = None, until = None):
+        """Index entries in archive order, optionally only of one query and a timestamp range."""
+        if not os.path.exists(self.index_path):
+            return []
+        selected = []
+        with open(self.index_path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line still being written by another process
+                    continue
+                if query is not None and entry["query"] != query:
+                    continue
+                if since is not None and entry["timestamp"] < since:
+                    continue
+                if until is not None and entry["timestamp"] >= until:
+                    continue
+                selected.append(entry)
+        return selected
+
+    def read(self, entry):
+        """The raw bytes of the page behind an index entry."""
+        with open(self._segment_path(entry["segment"]), "rb") as file:
+            file.seek(entry["offset"])
+            return zlib.decompress(file.read(entry["length"]))
+
+    def iter_pages(self, entries):
+        """Yield (entry, html) for entries, reading each archive file sequentially."""
+        segment, file = None, None
+        try:
+            for entry in sorted(entries, key=lambda entry: (entry["segment"], entry["offset"])):
+                if entry["segment"] != segment:
+                    if file:
+                        file.close()
+                    segment = entry["segment"]
+                    file = open(self._segment_path(segment), "rb")
+                file.seek(entry["offset"])
+                yield entry, zlib.decompress(file.read(entry["length"]))
+        finally:
+            if file:
+                file.close()
+
+def parse_chunk(directory, entries, parser = None):
+    """Worker: re-run the scraper.py extractors over a chunk of archived pages, return their records."""
+    from scraper import extract_records
+
+    records = []
+    for entry, html in HtmlArchive(directory).iter_pages(entries):
+        try:
+            records.extend(extract_records(html, entry["query"], entry["page"], parser))
+        except Exception as e:
+            logging.warning(f"Could not parse {entry['query']!r} page {entry['page']} from {entry['timestamp']}: {e}")
+    return len(entries), records
+
+def reparse(directory, out_path, query = None, since = None, until = None, workers = REPARSE_WORKERS, chunk = REPARSE_CHUNK, parser = None):
+    """Re-parse the archived pages in a process pool and stream their records to out_path.
+
+    Chunks are written as soon as a worker finishes one, in whatever order they complete,
+    so memory stays bounded by the chunks in flight. Returns (pages, records).
+    """
+    entries = HtmlArchive(directory).entries(query, since, until)
+    entries.sort(key=lambda entry: (entry["segment"], entry["offset"]))
+    chunks = [entries[start:start + chunk] for start in range(0, len(entries), chunk)]
+    started = time.monotonic()
+    pages = 0
+
+    with RecordWriter(out_path) as writer, ProcessPoolExecutor(max_workers=workers) as pool:
+        # Keep a couple of chunks per worker queued instead of submitting the whole archive at once
+        pending = set()
+        remaining = iter(chunks)
+        for batch in remaining:
+            pending.add(pool.submit(parse_chunk, directory, batch, parser))
+            if len(pending) >= workers * 2:
+                break
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                parsed, records = future.result()
+                writer.write(records)
+                pages += parsed
+                batch = next(remaining, None)
+                if batch is not None:
+                    pending.add(pool.submit(parse_chunk, directory, batch, parser))
+            logging.debug(f"Re-parsed {pages}/{len(entries)} pages")
+
+    elapsed = time.monotonic() - started
+    logging.info(f"Re-parsed {pages} pages into {writer.count} records in {elapsed:.1f}s ({pages / max(elapsed, 1e-9):.1f} pages/s)")
+    return pages, writer.count
+
+def parse_time(value):
+    """A timestamp from seconds since the epoch or an ISO date such as 2025-01-31."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return time.mktime(time.strptime(value, "%Y-%m-%d"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-parse the raw HTML archive offline into product records.")
+    parser.add_argument("--archive", default=HTML_ARCHIVE_DIR, help="Archive directory")
+    parser.add_argument("--out", default=None, help="Write the records to a .csv, .ndjson or .parquet file")
+    parser.add_argument("--query", default=None, help="Only pages of this query")
+    parser.add_argument("--since", default=None, help="Only pages fetched from this date (YYYY-MM-DD or epoch seconds)")
+    parser.add_argument("--until", default=None, help="Only pages fetched before this date")
+    parser.add_argument("--workers", type=int, default=REPARSE_WORKERS)
+    parser.add_argument("--chunk", type=int, default=REPARSE_CHUNK, help="Pages per worker task")
+    parser.add_argument("--parser", default=None, help="lxml, or a BeautifulSoup parser such as html.parser")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    since, until = parse_time(args.since), parse_time(args.until)
+    if args.out:
+        pages, records = reparse(args.archive, args.out, args.query, since, until, args.workers, args.chunk, args.parser)
+        print(f"Re-parsed {pages} pages into {records} records in {args.out}")
+    else:
+        entries = HtmlArchive(args.archive).entries(args.query, since, until)
+        for entry in entries:
+            fetched = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["timestamp"]))
+            print(f"{fetched}  {entry['query']!r} page {entry['page']}  {entry['size'] / 1024:.0f}KB")
+        print(f"{len(entries)} pages")
@@ -0,0 +1,102 @@
+import os
+import logging
+import threading
+import requests
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from image_store import get_image_store, InvalidImageError, IMAGE_REFRESH_AFTER
+from rate_limiter import rate_limited_get, IMAGE_RATE, IMAGE_BURST
+from metrics import metrics
+
+#Number of concurrent image downloads
+IMAGE_WORKERS = int(os.getenv("image_workers", "16"))
+
+# Every worker thread keeps one keep-alive session per image host
+_thread_state = threading.local()
+
+def get_session(url):
+    """Return the calling thread's pooled session for the host of url."""
+    sessions = getattr(_thread_state, "sessions", None)
+    if sessions is None:
+        sessions = _thread_state.sessions = {}
+
+    host = urlsplit(url).netloc
+    session = sessions.get(host)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        sessions[host] = session
+        logging.debug(f"Opened keep-alive session for image host: {host}")
+    return session
+
+def download_image(image_url, image_path):
+    """Place a single image at image_path through the image store, return False if it already existed unchanged."""
+    existed = os.path.exists(image_path)
+    if existed and not IMAGE_REFRESH_AFTER:
+        logging.debug(f"Image already exists: {image_path}")
+        return False
+
+    def fetch(headers):
+        response = rate_limited_get(image_url, session=get_session(image_url), per_endpoint=False, rate=IMAGE_RATE, burst=IMAGE_BURST, headers=headers, stream=True)
+        if response.status_code >= 400:
+            response.close()
+        response.raise_for_status()
+        return response
+
+    with metrics.timed("image_download_seconds"):
+        transferred = get_image_store().fetch_into(image_url, image_path, fetch)
+    return transferred or not existed
+
+def download_images(product_jobs, workers = IMAGE_WORKERS):
+    """Download the images of (product_uuid, [(product_uuid, image_url, image_path), ...]) pairs.
+
+    product_jobs may be a lazy iterable, it is only consumed while fewer than a few jobs
+    per worker are waiting. Yields (product_uuid, stats) as soon as every image of a product
+    is finished, where stats counts "total", "downloaded", "existing" and "failed" images.
+    A failed image is logged and counted, it does not stop the other downloads.
+    """
+    max_pending = workers * 4
+    remaining = {}
+    stats = {}
+    pending = {}
+
+    def finished(done):
+        for future in done:
+            product_uuid, image_url = pending.pop(future)
+            try:
+                downloaded = future.result()
+            except (requests.exceptions.RequestException, OSError, InvalidImageError) as err:
+                logging.error(f"Failed to download {image_url}: {err}")
+                stats[product_uuid]["failed"] += 1
+            else:
+                stats[product_uuid]["downloaded" if downloaded else "existing"] += 1
+
+            remaining[product_uuid] -= 1
+            if remaining[product_uuid] == 0:
+                del remaining[product_uuid]
+                yield product_uuid, stats.pop(product_uuid)
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+    try:
+        for product_uuid, jobs in product_jobs:
+            if not jobs:
+                yield product_uuid, Counter(total=0)
+                continue
+
+            remaining[product_uuid] = len(jobs)
+            stats[product_uuid] = Counter(total=len(jobs))
+            for _, image_url, image_path in jobs:
+                while len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from finished(done)
+                pending[executor.submit(download_image, image_url, image_path)] = product_uuid, image_url
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            yield from finished(done)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,231 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from metrics import metrics
+
+#Root of the content addressed image store
+IMAGE_STORE_DIR = os.getenv("image_store_dir", "image_store")
+
+#Revalidate stored images older than this many seconds with a conditional GET (0 never revalidates)
+IMAGE_REFRESH_AFTER = float(os.getenv("image_refresh_after", "0"))
+
+#Image bodies are streamed to disk in chunks of this size, bodies above image_max_mb are aborted
+IMAGE_CHUNK_SIZE = int(os.getenv("image_chunk_kb", "64")) * 1024
+IMAGE_MAX_BYTES = int(float(os.getenv("image_max_mb", "20")) * 1024 * 1024)
+
+# Leading bytes of the formats product images are served in (WebP: RIFF....WEBP)
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a")
+ACCEPTED_CONTENT_TYPES = ("image/", "application/octet-stream", "binary/octet-stream")
+
+class InvalidImageError(ValueError):
+    """A response body that is not an image, or is larger than allowed."""
+
+def check_image_header(url, head):
+    if head.startswith(IMAGE_SIGNATURES) or (head[:4] == b"RIFF" and head[8:12] == b"WEBP"):
+        return
+    raise InvalidImageError(f"{url} does not start with a known image signature: {head[:12]!r}")
+
+def normalize_url(url):
+    """Canonical form of an image URL: lowercase scheme and host, no default port, fragment or param order."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+class ImageStore:
+    """Content addressed image blobs, keyed by normalized URL and by SHA-256 of the bytes.
+
+    Each distinct image is stored once under blobs/<hash[:2]>/<hash>.jpg and product folders
+    get hardlinks to it (symlinks, then copies, where hardlinks are not possible). The URL
+    index keeps ETag, Last-Modified and size so stale entries are revalidated with a 304.
+    """
+
+    def __init__(self, root = IMAGE_STORE_DIR):
+        self.root = root
+        self.blob_dir = os.path.join(root, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(root, "index.sqlite"), timeout=30, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS urls (
+                    url TEXT PRIMARY KEY,
+                    sha256 TEXT,
+                    size INTEGER,
+                    fetched REAL,
+                    etag TEXT,
+                    last_modified TEXT
+                )
+            """)
+            columns = {row[1] for row in self._connection.execute("PRAGMA table_info(urls)")}
+            for column in ("etag", "last_modified"):
+                if column not in columns:
+                    self._connection.execute(f"ALTER TABLE urls ADD COLUMN {column} TEXT")
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+        metrics.inc("image_store_events_total", event=name)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], f"{digest}.jpg")
+
+    def lookup(self, url):
+        """Return the index entry of a normalized url whose blob is still stored, or None."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT sha256, size, fetched, etag, last_modified FROM urls WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None or not os.path.exists(self.blob_path(row[0])):
+            return None
+        return {
+            "path": self.blob_path(row[0]), "sha256": row[0], "size": row[1],
+            "fetched": row[2], "etag": row[3], "last_modified": row[4]
+        }
+
+    def add(self, url, response, max_bytes = IMAGE_MAX_BYTES, chunk_size = IMAGE_CHUNK_SIZE):
+        """Stream the body of response into the store for a normalized url, return the blob path.
+
+        The body goes chunk by chunk into a temp file while it is hashed, so memory stays at
+        one chunk per download. Wrong content types, unknown signatures and bodies over
+        max_bytes are rejected with InvalidImageError before anything lands in the store;
+        complete bodies are fsync'd and renamed into place, or dropped if already stored.
+        """
+        temp_path = os.path.join(self.blob_dir, f"incoming.{os.getpid()}.{threading.get_ident()}.tmp")
+        sha256 = hashlib.sha256()
+        head = b""
+        size = 0
+        try:
+            # Rejected responses are closed in the finally below like every other one
+            content_type = response.headers.get("Content-Type", "")
+            if content_type and not content_type.lower().startswith(ACCEPTED_CONTENT_TYPES):
+                raise InvalidImageError(f"{url} has content type {content_type}")
+            length = response.headers.get("Content-Length", "")
+            if length.isdigit() and int(length) > max_bytes:
+                raise InvalidImageError(f"{url} is {length} bytes, more than the limit of {max_bytes}")
+
+            with open(temp_path, "wb") as file:
+                # The body transfer is timed on its own, disk_write_seconds only covers the local disk work
+                with metrics.timed("image_transfer_seconds"):
+                    for chunk in response.iter_content(chunk_size):
+                        if len(head) < 12:
+                            head += chunk[:12 - len(head)]
+                            if len(head) == 12:
+                                check_image_header(url, head)
+                        size += len(chunk)
+                        if size > max_bytes:
+                            raise InvalidImageError(f"{url} exceeded the limit of {max_bytes} bytes")
+                        sha256.update(chunk)
+                        file.write(chunk)
+                with metrics.timed("disk_write_seconds", target="image"):
+                    file.flush()
+                    os.fsync(file.fileno())
+            if len(head) < 12:
+                check_image_header(url, head)
+
+            digest = sha256.hexdigest()
+            path = self.blob_path(digest)
+            if os.path.exists(path):
+                os.remove(temp_path)
+                self._count("content_hits")
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with metrics.timed("disk_write_seconds", target="image"):
+                    os.replace(temp_path, path)
+                self._count("stored_blobs")
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            response.close()
+            metrics.inc("http_bytes_total", size, endpoint=urlsplit(url).netloc)
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?, ?)",
+                (url, digest, size, time.time(), response.headers.get("ETag"), response.headers.get("Last-Modified"))
+            )
+        return path
+
+    def touch(self, url):
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE urls SET fetched = ? WHERE url = ?", (time.time(), url))
+
+    def fetch_into(self, url, image_path, fetch, refresh_after = IMAGE_REFRESH_AFTER):
+        """Place the image of url at image_path and return True if a body had to be transferred.
+
+        fetch(headers) must return the response of a GET sent with the given extra headers,
+        preferably with stream=True so the body is only read by add().
+        Known URLs are linked without a request until they are refresh_after seconds old,
+        then revalidated with If-None-Match / If-Modified-Since.
+        """
+        url = normalize_url(url)
+        entry = self.lookup(url)
+        if entry and not (refresh_after and time.time() - entry["fetched"] > refresh_after):
+            self._count("url_hits")
+            metrics.inc("image_requests_total", result="url_hit")
+            logging.debug(f"Reusing stored image for {url}")
+            with metrics.timed("disk_write_seconds", target="image"):
+                link_file(entry["path"], image_path)
+            return False
+
+        headers = {}
+        if entry and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = fetch(headers)
+        if entry and response.status_code == 304:
+            response.close()
+            self.touch(url)
+            self._count("not_modified")
+            metrics.inc("image_requests_total", result="not_modified")
+            with metrics.timed("disk_write_seconds", target="image"):
+                link_file(entry["path"], image_path)
+            return False
+
+        metrics.inc("image_requests_total", result="download")
+        blob = self.add(url, response)
+        with metrics.timed("disk_write_seconds", target="image"):
+            link_file(blob, image_path)
+        self._count("downloads")
+        return True
+
+def link_file(source, destination):
+    """Atomically point destination at source: hardlink, else symlink, else copy."""
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+
+    temp_path = f"{destination}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(source), temp_path)
+        except OSError:
+            shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_image_store():
+    """Return the process-wide image store, opening it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ImageStore()
+        return _store
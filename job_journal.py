@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import logging
+import threading
+from file_lock import file_lock
+
+class JobJournal:
+    """Append-only record of claimed, completed and failed pages, products and images.
+
+    Every state change is one JSON line in {name}.ndjson, failures are also written to
+    {name}.dead.ndjson as a log of every failure. Replaying the journal on start tells a
+    restarted run what is already done, what was in flight and what failed. The finished
+    items of a journal belong to one run: rotate() moves it aside once the run finished or
+    before a fresh run starts, keeping only what still has to be retried.
+    """
+
+    def __init__(self, name, directory = "journal"):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{name}.ndjson")
+        self.dead_letter_path = os.path.join(directory, f"{name}.dead.ndjson")
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._replay()
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn last line of a crashed run
+                    continue
+                self.entries[(entry["kind"], entry["key"])] = entry
+        logging.info(f"Replayed {len(self.entries)} journal entries from {self.path}")
+
+    def _append(self, entry, dead_letter = False):
+        line = json.dumps(entry) + "\n"
+        with self._lock, file_lock(self.path):
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line)
+                file.flush()
+            if dead_letter:
+                with open(self.dead_letter_path, "a", encoding="utf-8") as file:
+                    file.write(line)
+            self.entries[(entry["kind"], entry["key"])] = entry
+
+    def record(self, kind, key, status, data = None, error = None):
+        """Append a state change for the item kind/key."""
+        entry = {"kind": kind, "key": key, "status": status, "time": time.time(), "data": data}
+        if error is not None:
+            entry["error"] = str(error)
+        self._append(entry, dead_letter=status == "failed")
+
+    def status(self, kind, key):
+        entry = self.entries.get((kind, key))
+        return entry["status"] if entry else None
+
+    def is_done(self, kind, key):
+        return self.status(kind, key) == "done"
+
+    def pending(self, kind, **filters):
+        """Return the data of kind items that were claimed but never finished."""
+        return [
+            entry["data"] for (entry_kind, _), entry in list(self.entries.items())
+            if entry_kind == kind and entry["status"] not in ("done", "failed")
+            and all((entry["data"] or {}).get(name) == value for name, value in filters.items())
+        ]
+
+    def is_finished(self):
+        """True when every recorded item is done, nothing in flight and nothing failed."""
+        return all(entry["status"] == "done" for entry in list(self.entries.values()))
+
+    def rotate(self):
+        """Move the journal aside as {name}.{time}.ndjson and start a new one for the next run.
+
+        Failed and unfinished items are carried into the new journal: their ASINs are already
+        claimed in the archive, so a later run only fetches them again through --retry-failed.
+        """
+        with self._lock, file_lock(self.path):
+            carried = [entry for entry in self.entries.values() if entry["status"] != "done"]
+            if os.path.exists(self.path) and os.path.getsize(self.path):
+                temp_path = f"{self.path}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as file:
+                    file.writelines(json.dumps(entry) + "\n" for entry in carried)
+                # The old journal keeps its name until the new one replaces it, a crash loses neither
+                rotated_path = self._rotated_path()
+                os.link(self.path, rotated_path)
+                os.replace(temp_path, self.path)
+                logging.info(f"Rotated journal {self.path} to {rotated_path}, carried over {len(carried)} unfinished items")
+            self.entries = {(entry["kind"], entry["key"]): entry for entry in carried}
+
+    def _rotated_path(self):
+        """A free {name}.{time}.ndjson name, numbered when two rotations fall in the same second."""
+        stem = f"{self.path[:-len('.ndjson')]}.{time.strftime('%Y%m%d-%H%M%S')}"
+        rotated_path, number = f"{stem}.ndjson", 1
+        while os.path.exists(rotated_path):
+            rotated_path = f"{stem}-{number}.ndjson"
+            number += 1
+        return rotated_path
+
+    def dead_letters(self):
+        """Return the failed entries that have not succeeded since."""
+        return [entry for entry in list(self.entries.values()) if entry["status"] == "failed"]
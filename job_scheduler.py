@@ -0,0 +1,107 @@
+import json
+import logging
+import threading
+from collections import Counter, namedtuple
+
+DEFAULT_MARKETPLACE = {"domain": "com", "country": "us"}
+DEFAULT_PAGES = [1, 7]
+
+class Job(namedtuple("Job", ["query", "domain", "country", "pages"])):
+    """One search query on one marketplace over a range of result pages."""
+
+    @property
+    def name(self):
+        """Folder and journal name, the plain query for amazon.com so older runs line up."""
+        if (self.domain, self.country) == (DEFAULT_MARKETPLACE["domain"], DEFAULT_MARKETPLACE["country"]):
+            return self.query
+        return f"{self.query} ({self.domain}-{self.country})"
+
+def job_to_dict(job):
+    return {"query": job.query, "domain": job.domain, "country": job.country, "pages": [job.pages[0], job.pages[-1]] if job.pages else []}
+
+def job_from_dict(data):
+    return Job(data["query"], data["domain"], data["country"], parse_pages(data["pages"]))
+
+def parse_pages(pages):
+    """Accept [first, last], "first-last" or a single page number."""
+    if isinstance(pages, int):
+        return range(pages, pages + 1)
+    if isinstance(pages, str):
+        first, _, last = pages.partition("-")
+        return range(int(first), int(last or first) + 1)
+    first, last = pages
+    return range(int(first), int(last) + 1)
+
+def load_jobs(path):
+    """Expand a job file into one Job per query and marketplace.
+
+    {
+        "customizable": true,
+        "budget": {"run": 500, "daily": 2000},
+        "resume": false,
+        "jobs": [
+            {"query": "summer dress", "pages": "1-7",
+             "marketplaces": [{"domain": "com", "country": "us"}, {"domain": "co.uk", "country": "gb"}]}
+        ]
+    }
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        spec = json.load(file)
+
+    jobs = []
+    for entry in spec["jobs"]:
+        for marketplace in entry.get("marketplaces", [DEFAULT_MARKETPLACE]):
+            jobs.append(Job(
+                query=entry["query"],
+                domain=marketplace.get("domain", DEFAULT_MARKETPLACE["domain"]),
+                country=marketplace.get("country", DEFAULT_MARKETPLACE["country"]),
+                pages=parse_pages(entry.get("pages", DEFAULT_PAGES)),
+            ))
+    return spec, jobs
+
+def interleave_pages(jobs):
+    """Yield (job, page) round robin over the jobs, so every job makes progress from the start."""
+    iterators = [(job, iter(job.pages)) for job in jobs]
+    while iterators:
+        remaining = []
+        for job, pages in iterators:
+            page = next(pages, None)
+            if page is not None:
+                yield job, page
+                remaining.append((job, pages))
+        iterators = remaining
+
+class JobProgress:
+    """Per job counters shared by the pipeline threads."""
+
+    def __init__(self, jobs):
+        self.jobs = {job.name: job for job in jobs}
+        self.counters = {job.name: Counter() for job in jobs}
+        self._lock = threading.Lock()
+
+    def _track(self, job):
+        """Jobs a worker only learns about from its tasks are added on first use."""
+        self.jobs.setdefault(job.name, job)
+        return self.counters.setdefault(job.name, Counter())
+
+    def add(self, job, key, amount = 1):
+        with self._lock:
+            self._track(job)[key] += amount
+
+    def page_done(self, job, page):
+        with self._lock:
+            self._track(job)["pages_done"] += 1
+            done = self.counters[job.name]["pages_done"]
+        logging.info(f"[{job.name}] page {page} done ({done}/{len(job.pages)} pages)")
+        print(f"[{job.name}] page {page} done ({done}/{len(job.pages)} pages)")
+
+    def results(self):
+        with self._lock:
+            return {
+                name: {**job_to_dict(job), **self.counters[name]}
+                for name, job in self.jobs.items()
+            }
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.results(), file, indent=4)
@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#Live metrics: Prometheus text on metrics_port (0 disables it), a JSON snapshot every metrics_interval seconds
+METRICS_PORT = int(os.getenv("metrics_port", "0"))
+METRICS_SNAPSHOT = os.getenv("metrics_snapshot", "metrics.json")
+METRICS_INTERVAL = float(os.getenv("metrics_interval", "10"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Cache counters labelled by result, and the results served without transferring the body again
+CACHE_COUNTERS = ("response_cache_requests_total", "image_requests_total")
+HIT_RESULTS = ("hit", "url_hit", "not_modified")
+
+class Histogram:
+    """Cumulative bucket counts of observed values, Prometheus style."""
+
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+class Metrics:
+    """Thread-safe counters, histograms and gauges, keyed by name and labels."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """Observe the seconds spent in the with block, also when it raises."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def gauge(self, name, read, **labels):
+        """Register read() to be called for the current value, e.g. a queue's qsize."""
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = read
+
+    def remove_gauge(self, name, **labels):
+        with self._lock:
+            self.gauges.pop((name, tuple(sorted(labels.items()))), None)
+
+    def _gauge_values(self):
+        with self._lock:
+            gauges = list(self.gauges.items())
+        return [(key, read()) for key, read in gauges]
+
+    def snapshot(self):
+        """Plain dict of every metric, with p50/p99 latencies and cache hit ratios."""
+        with self._lock:
+            counters = list(self.counters.items())
+            histograms = [
+                (key, histogram.count, histogram.sum, histogram.quantile(0.5), histogram.quantile(0.99))
+                for key, histogram in self.histograms.items()
+            ]
+
+        snapshot = {"time": time.time(), "counters": {}, "histograms": {}, "gauges": {}, "hit_ratios": {}}
+        for (name, labels), value in counters:
+            snapshot["counters"].setdefault(name, []).append({"labels": dict(labels), "value": value})
+        for (name, labels), count, total, p50, p99 in histograms:
+            snapshot["histograms"].setdefault(name, []).append(
+                {"labels": dict(labels), "count": count, "sum": total, "p50": p50, "p99": p99}
+            )
+        for (name, labels), value in self._gauge_values():
+            snapshot["gauges"].setdefault(name, []).append({"labels": dict(labels), "value": value})
+
+        for name in CACHE_COUNTERS:
+            series = snapshot["counters"].get(name, [])
+            total = sum(entry["value"] for entry in series)
+            if total:
+                hits = sum(entry["value"] for entry in series if entry["labels"].get("result") in HIT_RESULTS)
+                snapshot["hit_ratios"][name] = hits / total
+        return snapshot
+
+    def render_prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        def series(name, labels, value, extra = ()):
+            pairs = [*labels, *extra]
+            text = ",".join(f'{key}="{str(val)}"' for key, val in pairs)
+            return f"{name}{{{text}}} {value}" if pairs else f"{name} {value}"
+
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = [(key, list(h.counts), h.sum, h.count, h.buckets) for key, h in sorted(self.histograms.items(), key=lambda item: item[0])]
+
+        for (name, labels), value in counters:
+            lines.append(series(name, labels, value))
+        for (name, labels), counts, total, count, buckets in histograms:
+            cumulative = 0
+            for bound, bucket_count in zip((*buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                lines.append(series(f"{name}_bucket", labels, cumulative, [("le", bound)]))
+            lines.append(series(f"{name}_sum", labels, total))
+            lines.append(series(f"{name}_count", labels, count))
+        for (name, labels), value in sorted(self._gauge_values(), key=lambda item: item[0]):
+            lines.append(series(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET /metrics (Prometheus text) and /metrics.json (snapshot)."""
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = metrics.render_prometheus().encode("utf-8"), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(metrics.snapshot()).encode("utf-8"), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Metrics request: {format % args}")
+
+def start_metrics_server(port = METRICS_PORT, host = "127.0.0.1"):
+    """Serve the metrics over HTTP in a daemon thread, return the server."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
+
+def write_snapshot(path = METRICS_SNAPSHOT):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(metrics.snapshot(), file, indent=4)
+    os.replace(temp_path, path)
+
+def start_snapshots(path = METRICS_SNAPSHOT, interval = METRICS_INTERVAL):
+    """Write a JSON snapshot every interval seconds until the returned event is set."""
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval):
+            try:
+                write_snapshot(path)
+            except OSError as e:
+                logging.warning(f"Could not write metrics snapshot {path}: {e}")
+
+    threading.Thread(target=loop, name="metrics-snapshot", daemon=True).start()
+    return stop
+
+@contextmanager
+def live_metrics(port = METRICS_PORT, path = METRICS_SNAPSHOT, interval = METRICS_INTERVAL):
+    """Expose metrics for the duration of a run and leave a final snapshot behind."""
+    server = None
+    if port:
+        try:
+            server = start_metrics_server(port)
+        except OSError as e:
+            # e.g. a second worker on the same machine, the JSON snapshot still works
+            logging.warning(f"Could not serve metrics on port {port}: {e}")
+    stop = start_snapshots(path, interval) if path else None
+    try:
+        yield metrics
+    finally:
+        if stop is not None:
+            stop.set()
+            write_snapshot(path)
+        if server is not None:
+            server.shutdown()
+            server.server_close()
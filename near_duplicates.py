@@ -0,0 +1,230 @@
+import os
+import sys
+import logging
+import sqlite3
+import argparse
+import numpy as np
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+
+#Index location and hashing settings
+HASH_INDEX_PATH = os.getenv("hash_index_path", "image_hashes.sqlite")
+HASH_WORKERS = int(os.getenv("hash_workers", str(os.cpu_count() or 1)))
+HASH_BATCH_SIZE = int(os.getenv("hash_batch", "256"))
+
+HASH_KINDS = ("ahash", "dhash", "phash")
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+def dct_matrix(size):
+    """Orthonormal DCT-II matrix, so a 2D DCT is D @ X @ D.T."""
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+_DCT_32 = dct_matrix(32)
+
+def pack_bits(bits):
+    """Pack an (N, 64) boolean array into N unsigned 64 bit hashes."""
+    return np.packbits(bits.astype(np.uint8), axis=1).view(">u8").ravel().astype(np.uint64)
+
+def load_gray(path, size):
+    with Image.open(path) as image:
+        return np.asarray(image.convert("L").resize(size, Image.LANCZOS), dtype=np.float32)
+
+def hash_images(paths):
+    """Return (path, ahash, dhash, phash) for every readable image, computed batch-wise with NumPy."""
+    loaded, small, wide, large = [], [], [], []
+    for path in paths:
+        try:
+            small.append(load_gray(path, (8, 8)))
+            wide.append(load_gray(path, (9, 8)))
+            large.append(load_gray(path, (32, 32)))
+            loaded.append(path)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Skipping unreadable image {path}: {e}")
+            del small[len(loaded):], wide[len(loaded):], large[len(loaded):]
+
+    if not loaded:
+        return []
+
+    small, wide, large = np.stack(small), np.stack(wide), np.stack(large)
+    count = len(loaded)
+
+    ahashes = pack_bits((small > small.mean(axis=(1, 2), keepdims=True)).reshape(count, 64))
+    dhashes = pack_bits((wide[:, :, 1:] > wide[:, :, :-1]).reshape(count, 64))
+
+    low = (_DCT_32 @ large @ _DCT_32.T)[:, :8, :8].reshape(count, 64)
+    medians = np.median(low[:, 1:], axis=1, keepdims=True)
+    phashes = pack_bits(low > medians)
+
+    return [
+        (path, int(ahash), int(dhash), int(phash))
+        for path, ahash, dhash, phash in zip(loaded, ahashes, dhashes, phashes)
+    ]
+
+def to_signed(value):
+    """SQLite integers are signed 64 bit."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+class BKTree:
+    """Burkhard-Keller tree over 64 bit hashes for "everything within distance k" queries."""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def query(self, value, k):
+        """Return (distance, item) for every item within Hamming distance k of value."""
+        results = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= k:
+                results.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - k <= child_distance <= distance + k:
+                    stack.append(child)
+        return results
+
+class HashIndex:
+    """Persistent perceptual hashes of every image under a tree, updated incrementally."""
+
+    def __init__(self, path = HASH_INDEX_PATH):
+        self._connection = sqlite3.connect(path, timeout=30)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS hashes (
+                    path TEXT PRIMARY KEY,
+                    mtime REAL,
+                    size INTEGER,
+                    ahash INTEGER,
+                    dhash INTEGER,
+                    phash INTEGER
+                )
+            """)
+
+    def update(self, base_dir, workers = HASH_WORKERS, batch_size = HASH_BATCH_SIZE):
+        """Hash new or changed images under base_dir in a process pool and forget removed ones.
+
+        Paths are stored normalized, so "Amazon/Women/" and "./Amazon/Women" share their entries.
+        """
+        base_dir = os.path.normpath(base_dir)
+        known = {
+            path: (mtime, size) for path, mtime, size in
+            self._connection.execute("SELECT path, mtime, size FROM hashes WHERE path >= ? AND path < ?", scope_range(base_dir))
+        }
+
+        changed, seen = [], set()
+        for dirpath, _, filenames in os.walk(base_dir):
+            for filename in filenames:
+                if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                path = os.path.normpath(os.path.join(dirpath, filename))
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Deleted (e.g. moved to the trash) while the tree was walked
+                    continue
+                seen.add(path)
+                if known.get(path) != (stat.st_mtime, stat.st_size):
+                    changed.append((path, stat.st_mtime, stat.st_size))
+
+        removed = [(path,) for path in known if path not in seen]
+        with self._connection:
+            self._connection.executemany("DELETE FROM hashes WHERE path = ?", removed)
+
+        stats = {path: (mtime, size) for path, mtime, size in changed}
+        batches = [[path for path, _, _ in changed[i:i + batch_size]] for i in range(0, len(changed), batch_size)]
+        def store(results_per_batch):
+            for number, results in enumerate(results_per_batch):
+                rows = [(path, *stats[path], *map(to_signed, hashes)) for path, *hashes in results]
+                with self._connection:
+                    self._connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)", rows)
+                logging.debug(f"Hashed batch {number + 1}/{len(batches)}")
+
+        # A single batch (e.g. one title folder) is not worth starting a pool for
+        if len(batches) <= 1:
+            store(map(hash_images, batches))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                store(pool.map(hash_images, batches))
+
+        logging.info(f"Hashed {len(changed)} images and removed {len(removed)} under {base_dir}")
+        return len(changed), len(removed)
+
+    def load_tree(self, base_dir, kind = "phash"):
+        """Build a BK-tree of every indexed image under base_dir."""
+        if kind not in HASH_KINDS:
+            raise ValueError(f"Unknown hash kind: {kind}")
+
+        tree = BKTree()
+        rows = self._connection.execute(f"SELECT path, {kind} FROM hashes WHERE path >= ? AND path < ?", scope_range(base_dir))
+        for path, value in rows:
+            tree.add(value & 0xFFFFFFFFFFFFFFFF, path)
+        return tree
+
+def scope_range(base_dir):
+    """Path range covering base_dir and everything below it, for paths stored normalized."""
+    base_dir = os.path.normpath(base_dir)
+    if base_dir == os.curdir:
+        # Normalized paths below the working directory have no "./" prefix
+        return "", chr(0x10FFFF)
+    prefix = os.path.join(base_dir, "")
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+def find_near_duplicates(base_dir, k = 6, kind = "phash", index = None, update = True):
+    """Group the images under base_dir (a title, a keyword or the whole tree) within Hamming distance k."""
+    index = index or HashIndex()
+    if update:
+        index.update(base_dir)
+    tree = index.load_tree(base_dir, kind)
+
+    groups, grouped = [], set()
+    stack = [tree.root] if tree.root else []
+    while stack:
+        node = stack.pop()
+        stack.extend(node[2].values())
+        for path in node[1]:
+            if path in grouped:
+                continue
+            group = sorted(item for _, item in tree.query(node[0], k) if item not in grouped)
+            grouped.update(group)
+            if len(group) > 1:
+                groups.append(group)
+    return groups
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find near-duplicate images by perceptual hash.")
+    parser.add_argument("base_dir", nargs="?", default="Amazon/Women", help="Title, keyword or root directory to search")
+    parser.add_argument("-k", type=int, default=6, help="Maximum Hamming distance")
+    parser.add_argument("--kind", choices=HASH_KINDS, default="phash")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    for group in find_near_duplicates(args.base_dir, args.k, args.kind):
+        print("\n".join(group))
+        print("")
@@ -0,0 +1,92 @@
+import os
+import time
+import logging
+import queue
+import threading
+from collections import Counter, namedtuple
+from metrics import metrics
+
+#Default capacity of the bounded queue in front of every stage
+QUEUE_SIZE = int(os.getenv("pipeline_queue_size", "32"))
+
+# fn(item) returns an iterable of items for the next stage (empty to drop the item)
+Stage = namedtuple("Stage", ["name", "fn", "workers", "maxsize"], defaults=[1, QUEUE_SIZE])
+
+_END = object()
+
+def run_pipeline(source, stages):
+    """Stream items from source through stages joined by bounded queues.
+
+    Each stage runs in its own pool of worker threads. A full queue blocks the stage
+    in front of it, so memory stays bounded no matter how many items the source yields.
+    An item whose stage function raises is logged and dropped without stopping the run.
+
+    Returns a Counter with the number of items processed and failed per stage.
+    """
+    queues = [queue.Queue(maxsize=stage.maxsize) for stage in stages]
+    stats = Counter()
+    stats_lock = threading.Lock()
+    threads = []
+
+    def feed():
+        try:
+            for item in source:
+                queues[0].put(item)
+        except Exception:
+            logging.exception("Pipeline source failed, closing the pipeline.")
+        finally:
+            for _ in range(stages[0].workers):
+                queues[0].put(_END)
+
+    def work(index, stage, finished):
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(stages) else None
+
+        while True:
+            item = inbox.get()
+            if item is _END:
+                break
+            started = time.monotonic()
+            try:
+                for output in stage.fn(item) or ():
+                    if outbox is not None:
+                        outbox.put(output)
+                with stats_lock:
+                    stats[f"{stage.name}_processed"] += 1
+                metrics.inc("pipeline_items_total", stage=stage.name, result="processed")
+            except Exception:
+                logging.exception(f"Stage {stage.name} failed for item: {item!r}")
+                with stats_lock:
+                    stats[f"{stage.name}_failed"] += 1
+                metrics.inc("pipeline_items_total", stage=stage.name, result="failed")
+            # Includes the time blocked on a full outbox, which is how back pressure shows up
+            metrics.observe("pipeline_stage_seconds", time.monotonic() - started, stage=stage.name)
+
+        # The last worker of a stage to finish closes the next stage
+        with stats_lock:
+            finished[stage.name] += 1
+            last = finished[stage.name] == stage.workers
+        if last and outbox is not None:
+            for _ in range(stages[index + 1].workers):
+                outbox.put(_END)
+
+    finished = Counter()
+    for stage, stage_queue in zip(stages, queues):
+        metrics.gauge("pipeline_queue_depth", stage_queue.qsize, stage=stage.name)
+    threads.append(threading.Thread(target=feed, name="pipeline-source", daemon=True))
+    for index, stage in enumerate(stages):
+        for number in range(stage.workers):
+            threads.append(threading.Thread(
+                target=work, args=(index, stage, finished),
+                name=f"pipeline-{stage.name}-{number}", daemon=True
+            ))
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for stage in stages:
+        metrics.remove_gauge("pipeline_queue_depth", stage=stage.name)
+
+    logging.debug(f"Pipeline finished with stats: {dict(stats)}")
+    return stats
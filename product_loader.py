@@ -0,0 +1,54 @@
+import os
+import json
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+#Parallel JSON loading settings, product_load_executor is "thread" or "process"
+LOAD_WORKERS = int(os.getenv("product_load_workers", str(min(8, os.cpu_count() or 1))))
+LOAD_CHUNK_SIZE = int(os.getenv("product_load_chunk", "64"))
+LOAD_EXECUTOR = os.getenv("product_load_executor", "thread")
+
+def load_json_chunk(paths):
+    """Parse a chunk of {UUID}.json files into (info, uuid) tuples."""
+    products = []
+    for path in paths:
+        with open(path, "rb") as file:
+            info = json.loads(file.read())
+        products.append((info, os.path.splitext(os.path.basename(path))[0]))
+    return products
+
+def iter_json_paths(folder_path):
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name.endswith(".json") and entry.is_file():
+                yield entry.path
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_json_chunks(folder_path, chunk_size = LOAD_CHUNK_SIZE, workers = LOAD_WORKERS, executor = LOAD_EXECUTOR):
+    """Yield lists of (info, uuid) parsed in a pool, keeping only a few chunks in flight.
+
+    The process pool parses outside the GIL, worth it for large folders of big files.
+    """
+    pool_class = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+    in_flight = deque()
+
+    with pool_class(max_workers=workers) as pool:
+        for paths in chunked(iter_json_paths(folder_path), chunk_size):
+            in_flight.append(pool.submit(load_json_chunk, paths))
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().result()
+
+        while in_flight:
+            yield in_flight.popleft().result()
+
+    logging.debug(f"Finished loading JSON files from {folder_path}")
@@ -0,0 +1,184 @@
+import os
+import re
+import csv
+import json
+
+# Columns of a product record, in output order
+FIELDS = (
+    "asin", "query", "page", "title", "price", "currency", "stars", "total_reviews", "image_url",
+    "is_sponsored", "is_amazon_choice", "is_best_seller", "other_tags",
+)
+
+# Arrow types of the columns, only used by the Parquet writer
+PARQUET_TYPES = {
+    "page": "int32", "price": "float64", "stars": "float32", "total_reviews": "int64",
+    "is_sponsored": "bool", "is_amazon_choice": "bool", "is_best_seller": "bool", "other_tags": "bool",
+}
+
+NUMBER = re.compile(r"\d[\d.,]*")
+SUFFIXES = {"k": 1_000, "m": 1_000_000}
+
+class ProductRecord:
+    """One search result with its numbers parsed, __slots__ keep it to a few hundred bytes."""
+
+    __slots__ = FIELDS
+
+    def __init__(self, asin, query = None, page = None, title = None, price = None, currency = None, stars = None,
+                 total_reviews = None, image_url = None, is_sponsored = False, is_amazon_choice = False,
+                 is_best_seller = False, other_tags = False):
+        self.asin = asin
+        self.query = query
+        self.page = page
+        self.title = title
+        self.price = price
+        self.currency = currency
+        self.stars = stars
+        self.total_reviews = total_reviews
+        self.image_url = image_url
+        self.is_sponsored = is_sponsored
+        self.is_amazon_choice = is_amazon_choice
+        self.is_best_seller = is_best_seller
+        self.other_tags = other_tags
+
+    @classmethod
+    def from_fields(cls, asin, fields, query = None, page = None):
+        """Build a record from the {"Price": "$1,299.99", ...} dict scraper.extract_products returns."""
+        price, currency = parse_price(fields.get("Price"))
+        image_urls = fields.get("Image_url") or [None]
+        return cls(
+            asin, query, page,
+            title=fields.get("Title"),
+            price=price,
+            currency=currency,
+            stars=parse_number(fields.get("Stars")),
+            total_reviews=parse_count(fields.get("Total_reviews")),
+            image_url=image_urls[0],
+            is_sponsored=bool(fields.get("Is_sponsored")),
+            is_amazon_choice=bool(fields.get("Is_amazon_choice")),
+            is_best_seller=bool(fields.get("Is_best_seller")),
+            other_tags=bool(fields.get("Other_tags")),
+        )
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in FIELDS}
+
+    def __repr__(self):
+        return f"ProductRecord({self.asin!r}, title={self.title!r}, price={self.price!r})"
+
+def parse_number(text):
+    """The first number in text as a float, e.g. 1299.99 from "1,299.99" or "1.299,99", None if there is none."""
+    if not text:
+        return None
+    match = NUMBER.search(text)
+    if not match:
+        return None
+    number = match.group().rstrip(".,")
+    last_dot, last_comma = number.rfind("."), number.rfind(",")
+    if last_dot >= 0 and last_comma >= 0:
+        # Both separators: the last one is the decimal mark
+        thousands = "," if last_dot > last_comma else "."
+        number = number.replace(thousands, "")
+    elif last_comma >= 0:
+        # Only commas: a decimal comma when one is followed by 1-2 digits ("4,5", "12,99")
+        is_decimal = number.count(",") == 1 and len(number) - last_comma - 1 in (1, 2)
+        number = number if is_decimal else number.replace(",", "")
+    elif number.count(".") > 1 or (last_dot >= 0 and len(number) - last_dot - 1 == 3 and number[0] != "0"):
+        # "1.234.567" or "1.234" use the dot for thousands
+        number = number.replace(".", "")
+    return float(number.replace(",", "."))
+
+def parse_price(text):
+    """Split a price such as "$1,299.99" into (1299.99, "$"), (None, None) when the card had no price."""
+    value = parse_number(text)
+    if value is None:
+        return None, None
+    currency = NUMBER.sub("", text).strip() or None
+    return value, currency
+
+def parse_count(text):
+    """Review counts such as "(1,234)" or "2.5K" as an int."""
+    value = parse_number(text)
+    if value is None:
+        return None
+    match = re.search(r"\d\s*([kKmM])\b", text)
+    if match:
+        value *= SUFFIXES[match.group(1).lower()]
+    return int(round(value))
+
+class CsvWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(FIELDS)
+
+    def write(self, records):
+        self.writer.writerows([getattr(record, field) for field in FIELDS] for record in records)
+
+    def close(self):
+        self.file.close()
+
+class NdjsonWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8")
+
+    def write(self, records):
+        self.file.writelines(json.dumps(record.to_dict(), ensure_ascii=False) + "\n" for record in records)
+
+    def close(self):
+        self.file.close()
+
+class ParquetWriter:
+    """Each write() becomes one row group, so only the current batch is held in memory."""
+
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Writing Parquet requires the pyarrow package (pip install pyarrow)")
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(field, PARQUET_TYPES.get(field, "string")) for field in FIELDS])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, records):
+        columns = {field: [getattr(record, field) for record in records] for field in FIELDS}
+        self.writer.write_table(self.pyarrow.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+WRITERS = {".csv": CsvWriter, ".ndjson": NdjsonWriter, ".jsonl": NdjsonWriter, ".parquet": ParquetWriter}
+
+class RecordWriter:
+    """Write batches of records to path, the format follows the extension (.csv, .ndjson/.jsonl, .parquet).
+
+    The file is written to a temporary name and only appears at path once closed.
+    """
+
+    def __init__(self, path):
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in WRITERS:
+            raise ValueError(f"Unknown record format {extension!r}, use one of {', '.join(WRITERS)}")
+        self.path = path
+        self.temp_path = f"{path}.tmp"
+        self.writer = WRITERS[extension](self.temp_path)
+        self.count = 0
+
+    def write(self, records):
+        if records:
+            self.writer.write(records)
+            self.count += len(records)
+
+    def close(self):
+        self.writer.close()
+        os.replace(self.temp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.close()
+            os.remove(self.temp_path)
@@ -0,0 +1,205 @@
+import os
+import time
+import random
+import logging
+import threading
+import requests
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from metrics import metrics
+
+#Request rate (per second) and burst size of every API endpoint and image host
+API_RATE = float(os.getenv("api_rate", "5"))
+API_BURST = int(os.getenv("api_burst", "10"))
+IMAGE_RATE = float(os.getenv("image_rate", "50"))
+IMAGE_BURST = int(os.getenv("image_burst", "50"))
+
+#Retry, concurrency and circuit breaker settings
+MAX_RETRIES = int(os.getenv("max_retries", "5"))
+BACKOFF_BASE = float(os.getenv("backoff_base", "1"))
+BACKOFF_CAP = float(os.getenv("backoff_cap", "60"))
+MAX_CONCURRENCY = int(os.getenv("max_concurrency", "32"))
+TARGET_LATENCY = float(os.getenv("target_latency", "5"))
+BREAKER_THRESHOLD = int(os.getenv("breaker_threshold", "5"))
+BREAKER_COOLDOWN = float(os.getenv("breaker_cooldown", "30"))
+
+#Seconds to wait for a connection and between bytes of a response, unless a call passes its own timeout
+CONNECT_TIMEOUT = float(os.getenv("connect_timeout", "10"))
+READ_TIMEOUT = float(os.getenv("read_timeout", "60"))
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """Allow rate requests per second on average with bursts of up to burst requests."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class AdaptiveLimiter:
+    """Concurrency limit tuned with AIMD: grow while healthy, halve on errors or slow responses."""
+
+    def __init__(self, initial = 4, minimum = 1, maximum = MAX_CONCURRENCY, target_latency = TARGET_LATENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency = None, error = False):
+        with self._condition:
+            self.in_flight -= 1
+            if error or (latency is not None and latency > self.target_latency):
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+class CircuitBreaker:
+    """Pause a host after threshold consecutive failures, then let one trial request through."""
+
+    def __init__(self, threshold = BREAKER_THRESHOLD, cooldown = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block while the breaker is open."""
+        while True:
+            with self._lock:
+                if self.opened_at is None:
+                    return
+                remaining = self.opened_at + self.cooldown - time.monotonic()
+                if remaining <= 0:
+                    # Half open: the next result decides whether it closes again
+                    self.opened_at = None
+                    self.failures = self.threshold - 1
+                    return
+            time.sleep(remaining)
+
+    def record(self, success):
+        with self._lock:
+            if success:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.threshold and self.opened_at is None:
+                self.opened_at = time.monotonic()
+                logging.warning(f"Circuit breaker opened for {self.cooldown}s after {self.failures} failures")
+
+class HostGuard:
+    """Token bucket, adaptive concurrency and circuit breaker of one endpoint or host."""
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.limiter = AdaptiveLimiter()
+        self.breaker = CircuitBreaker()
+
+def backoff_delay(attempt, retry_after = None):
+    """Exponential backoff with full jitter, or the server's Retry-After when it sent one."""
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+_guards = {}
+_guards_lock = threading.Lock()
+
+def get_guard(key, rate = API_RATE, burst = API_BURST):
+    """Return the shared guard for an endpoint or host key."""
+    with _guards_lock:
+        if key not in _guards:
+            _guards[key] = HostGuard(rate, burst)
+        return _guards[key]
+
+def guard_key(url, per_endpoint = True):
+    """API calls are limited per endpoint, image downloads per host."""
+    parts = urlsplit(url)
+    return f"{parts.netloc}{parts.path}" if per_endpoint else parts.netloc
+
+def rate_limited_get(url, session = None, per_endpoint = True, rate = API_RATE, burst = API_BURST, retries = MAX_RETRIES, classify = None, **kwargs):
+    """GET url through the guard of its endpoint/host, retrying 429, 5xx, connection errors and timeouts.
+
+    classify(response) may name a response that came back but is unusable, e.g. "captcha".
+    Such a response counts as a failure for the limiter and circuit breaker and is returned
+    at once without a retry, since retrying the same request would only get it again.
+    """
+    guard = get_guard(guard_key(url, per_endpoint), rate, burst)
+    get = session.get if session is not None else requests.get
+    # Without a timeout a hung connection would hold its limiter slot and worker thread forever
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+
+    endpoint = guard_key(url, per_endpoint)
+    for attempt in range(retries + 1):
+        if attempt:
+            metrics.inc("http_retries_total", endpoint=endpoint)
+        guard.breaker.wait()
+        guard.bucket.acquire()
+        guard.limiter.acquire()
+        started = time.monotonic()
+        try:
+            response = get(url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+            metrics.inc("http_errors_total", endpoint=endpoint, error=type(err).__name__)
+            guard.limiter.release(error=True)
+            guard.breaker.record(False)
+            if attempt == retries:
+                raise
+            delay = backoff_delay(attempt)
+            logging.warning(f"Request to {url} failed ({err}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        except Exception:
+            guard.limiter.release(error=True)
+            raise
+
+        blocked = classify(response) if classify is not None else None
+        failed = bool(blocked) or response.status_code in RETRY_STATUS_CODES
+        latency = time.monotonic() - started
+        guard.limiter.release(latency=latency, error=failed)
+        metrics.observe("http_request_seconds", latency, endpoint=endpoint)
+        metrics.inc("http_responses_total", endpoint=endpoint, status=response.status_code)
+        if not kwargs.get("stream"):
+            metrics.inc("http_bytes_total", len(response.content), endpoint=endpoint)
+        guard.breaker.record(not failed)
+        if blocked:
+            metrics.inc("http_blocked_total", endpoint=endpoint, reason=blocked)
+            return response
+        if not failed or attempt == retries:
+            return response
+
+        # Hand a streamed connection back to the pool before retrying
+        response.close()
+        delay = backoff_delay(attempt, response.headers.get("Retry-After"))
+        logging.warning(f"Got status {response.status_code} from {url}, retrying in {delay:.1f}s")
+        time.sleep(delay)
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import logging
+import sqlite3
+import threading
+import requests
+from metrics import metrics
+
+#Cache settings, api_cache is one of "use", "refresh" (always fetch, then store) or "bypass"
+CACHE_PATH = os.getenv("api_cache_path", "api_cache.sqlite")
+CACHE_MODE = os.getenv("api_cache", "use")
+CACHE_TTL = float(os.getenv("api_cache_ttl", str(7 * 24 * 60 * 60)))
+CACHE_MAX_BYTES = int(float(os.getenv("api_cache_max_mb", "512")) * 1024 * 1024)
+
+class ResponseCache:
+    """Disk-backed LRU cache of successful API responses with a time to live."""
+
+    def __init__(self, path = CACHE_PATH, ttl = CACHE_TTL, max_bytes = CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    url TEXT,
+                    body BLOB,
+                    size INTEGER,
+                    created REAL,
+                    accessed REAL
+                )
+            """)
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @staticmethod
+    def make_key(url, params):
+        """Key a request on its endpoint and params, without the api_key."""
+        params = {key: str(value) for key, value in params.items() if key != "api_key"}
+        raw = json.dumps([url, params], sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, url, params):
+        """Return a cached response object, or None on a miss or an expired entry."""
+        key = self.make_key(url, params)
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT body, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.encoding = "utf-8"
+        response.headers["X-Cache"] = "HIT"
+        response._content = zlib.decompress(row[0])
+        return response
+
+    def put(self, url, params, response):
+        """Store a successful response and evict the least recently used entries over max_bytes."""
+        if response.status_code != 200:
+            return
+
+        key = self.make_key(url, params)
+        body = zlib.compress(response.content)
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, url, body, len(body), now, now)
+            )
+            total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total_size > self.max_bytes:
+                self._evict(total_size)
+
+    def _evict(self, total_size):
+        rows = self._connection.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total_size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total_size -= size
+        self._connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logging.debug(f"Evicted {len(evicted)} cached responses")
+
+    def cached_get(self, url, params, fetch, mode = CACHE_MODE):
+        """Serve url/params from the cache, calling fetch() on a miss or when mode asks for it."""
+        if mode == "bypass":
+            metrics.inc("response_cache_requests_total", result="bypass")
+            return fetch()
+
+        if mode != "refresh":
+            response = self.get(url, params)
+            if response is not None:
+                logging.debug(f"Cache hit for {url}")
+                metrics.inc("response_cache_requests_total", result="hit")
+                return response
+
+        metrics.inc("response_cache_requests_total", result="miss" if mode != "refresh" else "refresh")
+        response = fetch()
+        self.put(url, params, response)
+        return response
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """Return the process-wide response cache, opening it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
@@ -1,124 +1,406 @@
-import requests
+import os
+import re
+import html as html_entities
 import json
-from bs4 import BeautifulSoup
-from collections import defaultdict
-
-# Initialize a dictionary to hold ASIN-related data
-tag_dict = defaultdict(dict)
-
-def find_asin(soup):
-    """Find ASIN from a given BeautifulSoup object."""
-    for parent in soup.parents:
-        if parent.name == "div" and "puis-card-container" in parent.get("class", {}) and "s-card-container" in parent.get("class", {}):
-            return parent["data-dib-asin"]
-
-def reviews_number(soup):
-    """Extract the total number of reviews for products."""
-    review_component = soup.find_all("div", {"data-csa-c-content-id": "alf-customer-ratings-count-component"})
-    for each_component in review_component:
-        total_reviews = each_component.find("span").get_text()
-        asin = find_asin(each_component)
-        tag_dict[asin]["Total_reviews"] = total_reviews
-
-def stars_number(soup):
-    """Extract the average number of stars for products."""
-    star_component = soup.find_all("i", {"data-cy": "reviews-ratings-slot"})
-    for each_component in star_component:
-        stars = each_component.parent.get("aria-label").split()[0]
-        asin = find_asin(each_component)
-        tag_dict[asin]["Stars"] = stars
-
-def info_tags(soup):
-    """Extract specific tags for products."""
-    badge_component = soup.find_all("span", {"data-component-type": "s-status-badge-component"})
-    for element in badge_component:
-        tag_str = element["data-component-props"]
-        tag = json.loads(tag_str) 
-        asin = find_asin(element) 
-        badge_type = tag["badgeType"]
-        if badge_type == "amazons-choice":
-            tag_dict[asin]["Is_amazon_choice"] = True
-        elif badge_type == "best-seller":
-            tag_dict[asin]["Is_best_seller"] = True
-        else:
-            tag_dict[asin]["Other_tags"] = True
-
-    return tag_dict
-
-def get_image_url(soup):
-    """Extract image URLs for products."""
-    images = soup.find_all("img", {"class": "s-image"})
-    for image in images:
-        asin = find_asin(image)
-        image_url = [image['src']]
-        tag_dict[asin]["Image_url"] = image_url
-
-def get_title(soup):
-    """Extract product titles."""
-    titles = []
-    class_string = "a-section a-spacing-small puis-padding-left-small puis-padding-right-small"
-    div = soup.find_all("div", {"class": class_string})
-    for lower_part in div:
-        asin = find_asin(lower_part)
-        title_header = lower_part.find("h2")
-        title = title_header["aria-label"]
-        if title.split()[0] == "Sponsored":
-            tag_dict[asin]["Is_sponsored"] = True
-            title = title.split()
-            title = " ".join(title[3:])
-        titles.append(title)
-        tag_dict[asin]["Title"] = title
-    return titles
-
-def get_price(soup):
-    """Extract product prices."""
-    result = []
-    outer_span = soup.find_all("span", {"class": "a-price"})
-    for span in outer_span:
-        asin = find_asin(span)
-        price_tag = span.find("span", {"class": "a-offscreen"})
-        price = price_tag.get_text(strip=True) if price_tag else "Price not found"
-        result.append(price) 
-        tag_dict[asin]["Price"] = price
-    return result
-
-def wrapper(soup):
-    """Main function to wrap all extraction methods."""
-    get_price(soup)
-    get_title(soup)
-    info_tags(soup)
-    get_image_url(soup)
-    reviews_number(soup)
-    stars_number(soup)
+import time
+import random
+import logging
+import argparse
+import threading
+import requests
+from collections import Counter
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus, urljoin
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer
+from product_records import ProductRecord, RecordWriter
+from html_archive import HtmlArchive, HTML_ARCHIVE_DIR
+from rate_limiter import rate_limited_get, backoff_delay
+from metrics import metrics
+
+try:
+    import lxml.html
+    # lxml builds and searches the tree in C, several times faster than BeautifulSoup
+    PARSER = "lxml"
+except ImportError:
+    lxml = None
+    PARSER = "html.parser"
+
+try:
+    from fake_useragent import UserAgent
+except ImportError:
+    UserAgent = None
+
+#Direct-fetch mode: the site searched, queries crawled at once, pages per query and the request rate to the site
+AMAZON_BASE_URL = os.getenv("amazon_base_url", "https://www.amazon.com")
+DIRECT_WORKERS = int(os.getenv("direct_workers", "4"))
+DIRECT_MAX_PAGES = int(os.getenv("direct_max_pages", "20"))
+DIRECT_RATE = float(os.getenv("direct_rate", "1"))
+DIRECT_BURST = int(os.getenv("direct_burst", "2"))
+
+#Attempts at a page that keeps answering with a captcha, each after a backoff on a fresh session
+CAPTCHA_RETRIES = int(os.getenv("captcha_retries", "3"))
+
+# Used when fake_useragent is not installed or cannot load its data
+USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Safari/605.1.15",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+)
+
+# Browser header sets, a session keeps one for its whole life together with its cookies
+HEADER_PROFILES = (
+    {
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
+        "Accept-Language": "en-US,en;q=0.9",
+        "Accept-Encoding": "gzip, deflate",
+        "Upgrade-Insecure-Requests": "1",
+    },
+    {
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        "Accept-Language": "en-US,en;q=0.5",
+        "Accept-Encoding": "gzip, deflate",
+        "DNT": "1",
+    },
+    {
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        "Accept-Language": "en-GB,en;q=0.8,en-US;q=0.6",
+        "Accept-Encoding": "gzip, deflate",
+        "Cache-Control": "max-age=0",
+    },
+)
+
+# Text of Amazon's captcha and robot check pages, which may come with status 200 or 503
+CAPTCHA_MARKERS = (
+    b"/errors/validateCaptcha",
+    b"Type the characters you see in this image",
+    b"api-services-support@amazon.com",
+    b"<title>Robot Check</title>",
+)
+
+# The next page link of the results, disabled on the last page (then a span, not a link)
+NEXT_LINK = re.compile(rb'<a\b[^>]*\bs-pagination-next\b[^>]*>', re.IGNORECASE)
+HREF = re.compile(rb'\bhref="([^"]+)"')
+
+TITLE_CLASS = "a-section a-spacing-small puis-padding-left-small puis-padding-right-small"
+
+# Only the result cards are built into a tree, navigation, scripts and the rest of the page are skipped
+CARD_STRAINER = SoupStrainer("div", attrs={"data-dib-asin": True})
+
+def has_class(name):
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+# XPath of the cards and, relative to a card, of every field
+CARD_XPATH = f'//div[@data-dib-asin and {has_class("puis-card-container")} and {has_class("s-card-container")}]'
+PRICE_XPATH = f'.//span[{has_class("a-price")}]'
+OFFSCREEN_XPATH = f'.//span[{has_class("a-offscreen")}]'
+BADGE_XPATH = './/span[@data-component-type="s-status-badge-component"]'
+REVIEWS_XPATH = './/div[@data-csa-c-content-id="alf-customer-ratings-count-component"]'
+TITLE_XPATH = f'.//div[{" and ".join(has_class(name) for name in TITLE_CLASS.split())}]'
+IMAGE_XPATH = f'.//img[{has_class("s-image")}]'
+STARS_XPATH = './/i[@data-cy="reviews-ratings-slot"]'
+
+def is_card(element):
+    """Result cards are the puis/s-card container divs that carry the ASIN."""
+    classes = element.get("class", ())
+    return "puis-card-container" in classes and "s-card-container" in classes
+
+def find_cards(soup):
+    """Index every result card of a search page by its data-dib-asin."""
+    cards = {}
+    for element in soup.find_all("div", attrs={"data-dib-asin": True}):
+        if is_card(element):
+            cards[element["data-dib-asin"]] = element
+    return cards
+
+def extract_card(card):
+    """Extract every field of one result card in a single walk over its elements."""
+    product = {}
+    for element in card.find_all(True):
+        name = element.name
+        attrs = element.attrs
+
+        if name == "span":
+            classes = attrs.get("class", ())
+            if "a-price" in classes:
+                price_tag = element.find("span", {"class": "a-offscreen"})
+                product["Price"] = price_tag.get_text(strip=True) if price_tag else "Price not found"
+            elif attrs.get("data-component-type") == "s-status-badge-component":
+                badge_fields(product, attrs["data-component-props"])
+
+        elif name == "div":
+            if attrs.get("data-csa-c-content-id") == "alf-customer-ratings-count-component":
+                product["Total_reviews"] = element.find("span").get_text()
+            elif " ".join(attrs.get("class", ())) == TITLE_CLASS:
+                title_fields(product, element.find("h2")["aria-label"])
+
+        elif name == "img" and "s-image" in attrs.get("class", ()):
+            product["Image_url"] = [attrs["src"]]
+
+        elif name == "i" and attrs.get("data-cy") == "reviews-ratings-slot":
+            product["Stars"] = element.parent.get("aria-label").split()[0]
+
+    return product
+
+def badge_fields(product, props):
+    badge_type = json.loads(props)["badgeType"]
+    if badge_type == "amazons-choice":
+        product["Is_amazon_choice"] = True
+    elif badge_type == "best-seller":
+        product["Is_best_seller"] = True
+    else:
+        product["Other_tags"] = True
+
+def title_fields(product, title):
+    if title.split()[0] == "Sponsored":
+        product["Is_sponsored"] = True
+        title = " ".join(title.split()[3:])
+    product["Title"] = title
+
+def extract_card_lxml(card):
+    """The same fields as extract_card from an lxml card element, one XPath query per field."""
+    product = {}
+    for price in card.xpath(PRICE_XPATH):
+        price_tag = price.xpath(OFFSCREEN_XPATH)
+        product["Price"] = "".join(text.strip() for text in price_tag[0].itertext()) if price_tag else "Price not found"
+    for badge in card.xpath(BADGE_XPATH):
+        badge_fields(product, badge.get("data-component-props"))
+    for reviews in card.xpath(REVIEWS_XPATH):
+        product["Total_reviews"] = "".join(reviews.xpath(".//span")[0].itertext())
+    for title in card.xpath(TITLE_XPATH):
+        # Same match as BeautifulSoup's class string: exactly these classes, in this order
+        if " ".join(title.get("class", "").split()) == TITLE_CLASS:
+            title_fields(product, title.xpath(".//h2")[0].get("aria-label"))
+    for image in card.xpath(IMAGE_XPATH):
+        product["Image_url"] = [image.get("src")]
+    for stars in card.xpath(STARS_XPATH):
+        product["Stars"] = stars.getparent().get("aria-label").split()[0]
+    return product
+
+def extract_products(html, parser = None, timings = None):
+    """Parse a search page and return {asin: fields} for every result card.
+
+    parser "lxml" uses lxml directly, any other name is a BeautifulSoup parser. Pass a
+    dict as timings to get the seconds spent building the tree ("parse") and
+    extracting the cards ("extract").
+    """
+    parser = parser or PARSER
+    started = time.perf_counter()
+    if parser == "lxml" and lxml is not None:
+        tree = lxml.html.fromstring(html)
+        parsed = time.perf_counter()
+        products = {card.get("data-dib-asin"): extract_card_lxml(card) for card in tree.xpath(CARD_XPATH)}
+    else:
+        soup = BeautifulSoup(html, parser, parse_only=CARD_STRAINER)
+        parsed = time.perf_counter()
+        products = {asin: extract_card(card) for asin, card in find_cards(soup).items()}
+    finished = time.perf_counter()
+
+    if timings is not None:
+        timings["parse"] = parsed - started
+        timings["extract"] = finished - parsed
+    logging.debug(f"Parsed page in {parsed - started:.3f}s, extracted {len(products)} cards in {finished - parsed:.3f}s")
+    return products
+
+def extract_records(html, query = None, page = None, parser = None, timings = None):
+    """The products of a search page as a new list of ProductRecord, nothing is kept between calls."""
+    products = extract_products(html, parser, timings)
+    return [ProductRecord.from_fields(asin, fields, query, page) for asin, fields in products.items()]
+
+def write_pages(paths, out_path, query = None, parser = None):
+    """Parse saved search pages one at a time and stream their records to out_path, return the record count."""
+    with RecordWriter(out_path) as writer:
+        for page, path in enumerate(paths, start=1):
+            with open(path, "rb") as file:
+                writer.write(extract_records(file.read(), query, page, parser))
+    logging.info(f"Wrote {writer.count} records from {len(paths)} pages to {out_path}")
+    return writer.count
+
+_user_agents = None
+_user_agents_lock = threading.Lock()
+_thread_state = threading.local()
+
+def random_user_agent():
+    """A random browser User-Agent from fake_useragent, or from USER_AGENTS without it."""
+    global _user_agents
+    if UserAgent is not None:
+        with _user_agents_lock:
+            if _user_agents is None:
+                try:
+                    _user_agents = UserAgent()
+                except Exception as e:
+                    logging.warning(f"fake_useragent is unavailable ({e}), using the built-in user agents")
+                    _user_agents = False
+        if _user_agents:
+            return _user_agents.random
+    return random.choice(USER_AGENTS)
+
+def get_session(new = False):
+    """Return the calling thread's keep-alive session, or replace it with one with a new header profile."""
+    session = getattr(_thread_state, "session", None)
+    if session is None or new:
+        if session is not None:
+            session.close()
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update(random.choice(HEADER_PROFILES))
+        session.headers["User-Agent"] = random_user_agent()
+        _thread_state.session = session
+    return session
+
+def is_captcha(content):
+    return any(marker in content for marker in CAPTCHA_MARKERS)
+
+def classify_page(response):
+    """rate_limited_get classifier: a captcha is a failure, whatever its status code."""
+    return "captcha" if is_captcha(response.content) else None
+
+def next_page_url(content, url):
+    """Absolute URL of the next results page, None on the last page."""
+    link = NEXT_LINK.search(content)
+    href = HREF.search(link.group()) if link else None
+    if href is None:
+        return None
+    return urljoin(url, html_entities.unescape(href.group(1).decode("utf-8")))
+
+def search_url(query, base_url = None):
+    return f"{base_url or AMAZON_BASE_URL}/s?k={quote_plus(query)}"
+
+def fetch_page(url, referer = None):
+    """GET a page over the thread's pooled session, return its bytes or None if it could not be had.
+
+    A captcha is classified inside the guarded request, so it is never retried on the flagged
+    session and counts as a failure for the host's circuit breaker: a run of them pauses all
+    workers instead of hammering the site. The flagged session is closed and replaced by one
+    with another profile, and the page is tried again after a backoff.
+    """
+    headers = {"Referer": referer} if referer else {}
+    for attempt in range(CAPTCHA_RETRIES + 1):
+        response = rate_limited_get(url, session=get_session(), per_endpoint=False, rate=DIRECT_RATE, burst=DIRECT_BURST,
+                                    classify=classify_page, headers=headers)
+        if classify_page(response):
+            metrics.inc("direct_pages_total", result="captcha")
+            get_session(new=True)
+            delay = backoff_delay(attempt + 1)
+            logging.warning(f"Captcha on {url}, retrying with a new session in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        if response.status_code != 200:
+            metrics.inc("direct_pages_total", result="error")
+            logging.error(f"Failed to retrieve {url}. Status code: {response.status_code}")
+            return None
+        metrics.inc("direct_pages_total", result="ok")
+        return response.content
+
+    logging.error(f"Giving up on {url} after {CAPTCHA_RETRIES + 1} captchas")
+    return None
+
+def crawl_query(query, max_pages = DIRECT_MAX_PAGES, base_url = None, archive = None, parser = None):
+    """Yield (page, records) of a query, following the next page links of the results."""
+    url, referer = search_url(query, base_url), None
+    for page in range(1, max_pages + 1):
+        content = fetch_page(url, referer)
+        if content is None:
+            return
+        if archive is not None:
+            archive.put(query, page, content, url)
+        yield page, extract_records(content, query, page, parser)
+
+        next_url = next_page_url(content, url)
+        if next_url is None:
+            return
+        url, referer = next_url, url
+
+def crawl(queries, out_path = None, max_pages = DIRECT_MAX_PAGES, workers = DIRECT_WORKERS, base_url = None, archive = True, parser = None):
+    """Crawl queries straight from the site, one query per worker thread, streaming the records to out_path.
+
+    The raw pages go to the HTML archive unless archive is False. Returns a Counter of the
+    queries, pages and products crawled.
+    """
+    stats = Counter()
+    lock = threading.Lock()
+    archive = HtmlArchive() if archive else None
+
+    with (RecordWriter(out_path) if out_path else nullcontext()) as writer:
+        def work(query):
+            try:
+                for page, records in crawl_query(query, max_pages, base_url, archive, parser):
+                    with lock:
+                        if writer is not None:
+                            writer.write(records)
+                        stats["pages"] += 1
+                        stats["products"] += len(records)
+                    logging.info(f"{query!r} page {page}: {len(records)} products")
+                outcome = "queries"
+            except Exception as e:
+                logging.error(f"Crawling {query!r} failed: {e}")
+                outcome = "failed_queries"
+            with lock:
+                stats[outcome] += 1
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(work, queries))
+
+    logging.info(f"Crawled {stats['pages']} pages with {stats['products']} products for {stats['queries']} queries")
+    return stats
+
+def wrapper(html, parser = None):
+    """Main function to extract and display every product of a search page."""
+    timings = {}
+    products = extract_products(html, parser, timings)
 
     # Display results
-    for each_asin in tag_dict.keys():
+    for each_asin, product in products.items():
         print(f"{each_asin}:")
-        for each_attribute in tag_dict[each_asin].keys():
-            print(f"  {each_attribute}:    {tag_dict[each_asin][each_attribute]}")
+        for each_attribute, value in product.items():
+            print(f"  {each_attribute}:    {value}")
         print("\n")
+    print(f"Parsed in {timings['parse'] * 1000:.1f}ms, extracted {len(products)} products in {timings['extract'] * 1000:.1f}ms")
+    return products
 
-# Amazon search URL
-url = 'https://www.amazon.com/s?k=gamings'
-
-# Custom headers for request
-headers = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36',
-    'Referer': 'https://google.com',
-    'Origin': 'https://www.amazon.com',
-    "Accept-Language": "en-US"
-}
-
-# Make a GET request to fetch the raw HTML content
-response = requests.get(url, headers=headers)
-
-# Check if the request was successful
-if response.status_code == 200:
-    # Parse the HTML content using BeautifulSoup
-    soup = BeautifulSoup(response.content, 'html.parser')
-    wrapper(soup)
-    
-    # print(soup.prettify())
-else:
-    print(f"Failed to retrieve the page. Status code: {response.status_code}")
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Extract the products of an Amazon search page.")
+    arg_parser.add_argument("--url", default=search_url("gamings"), help="Amazon search URL")
+    arg_parser.add_argument("--crawl", nargs="+", default=None, help="Crawl these queries straight from the site")
+    arg_parser.add_argument("--pages", type=int, default=DIRECT_MAX_PAGES, help="Pages to follow per crawled query")
+    arg_parser.add_argument("--workers", type=int, default=DIRECT_WORKERS, help="Queries crawled at once")
+    arg_parser.add_argument("--base-url", default=AMAZON_BASE_URL, help="Site to crawl, e.g. a local fixture server")
+    arg_parser.add_argument("--html", nargs="+", default=None, help="Parse saved search pages instead of fetching one")
+    arg_parser.add_argument("--out", default=None, help="Write the records to a .csv, .ndjson or .parquet file instead of printing them")
+    arg_parser.add_argument("--query", default=None, help="Query recorded with every record")
+    arg_parser.add_argument("--no-archive", action="store_true", help=f"Do not keep the fetched page in {HTML_ARCHIVE_DIR}")
+    arg_parser.add_argument("--parser", default=PARSER, help="lxml, or a BeautifulSoup parser such as html.parser")
+    args = arg_parser.parse_args()
 
+    if args.crawl:
+        logging.basicConfig(level=logging.INFO)
+        stats = crawl(args.crawl, args.out, args.pages, args.workers, args.base_url, not args.no_archive, args.parser)
+        print(f"Crawled {stats['pages']} pages with {stats['products']} products for {stats['queries']} queries")
+    elif args.html and args.out:
+        count = write_pages(args.html, args.out, args.query, args.parser)
+        print(f"Wrote {count} records to {args.out}")
+    elif args.html:
+        for path in args.html:
+            with open(path, "rb") as file:
+                wrapper(file.read(), args.parser)
+    else:
+        # Fetch the raw HTML content over a pooled session with a browser header profile
+        content = fetch_page(args.url)
+
+        # Keep the raw page so it can be re-parsed later without fetching it again
+        if content is not None and not args.no_archive:
+            HtmlArchive().put(args.query, 1, content, args.url)
+
+        if content is not None and args.out:
+            with RecordWriter(args.out) as writer:
+                writer.write(extract_records(content, args.query, 1, args.parser))
+            print(f"Wrote {writer.count} records to {args.out}")
+        elif content is not None:
+            wrapper(content, args.parser)
+        else:
+            print(f"Failed to retrieve the page {args.url}")
@@ -5,71 +5,133 @@ import re
 import uuid
 import logging
 import sys
+import threading
+import time
 from dotenv import load_dotenv
 from collections import Counter
+from image_downloader import download_images, download_image, IMAGE_WORKERS
+from image_store import InvalidImageError
+from pipeline import run_pipeline, Stage
+from response_cache import get_response_cache, CACHE_MODE
+from rate_limiter import rate_limited_get, backoff_delay
+from job_journal import JobJournal
+from segment_store import SegmentStore, open_store
+from product_loader import iter_json_chunks, chunked, LOAD_CHUNK_SIZE
+from asin_index import get_asin_index
+from job_scheduler import Job, JobProgress, load_jobs, interleave_pages, job_to_dict, job_from_dict
+from work_queue import open_work_queue, run_worker, default_worker_id
+from metrics import metrics, live_metrics, METRICS_SNAPSHOT
+from credit_budget import open_budget, product_priority, SEARCH_CREDITS, PRODUCT_CREDITS, EXPECTED_PRODUCTS_PER_PAGE
 
 # Load environment variables from .env file
 load_dotenv()
 
-#Terminal prompts and required options for scraping/extraction to begin
+#Required options for scraping/extraction to begin, set by prompt_options() or the job file
 global search_query
-search_query = sys.argv[1]
+search_query = None
 
 global extractor
-extractor_prompt = input("Continue with scraping functionality or not (extraction functionality)? (y/n)")
-extractor = False if extractor_prompt.lower() == "y" else True
+extractor = False
 
 global customizable
-if extractor is True:
-    customizable_opt_prompt = input("Allowing customization options containing products? (y/n)") 
-    customizable = True if customizable_opt_prompt.lower() == "y" else False
-else:
-    customizable = True
+customizable = True
 
 global counter
 counter = Counter()
 
-def generate_uuid():
-    return str(uuid.uuid4())
+# Counter is shared by the pipeline stage threads
+counter_lock = threading.Lock()
 
-def is_unique_asin(asin, asin_set = set()):
-    if asin not in asin_set:
-        return True
+# Job journals by job name and per job progress of the running pipeline
+journals = {}
+global progress
+progress = None
 
-    logging.debug(f"{asin} already exists")
-    return False
+# Shared work queue, set in worker mode only
+global work_queue
+work_queue = None
 
-def append_asin(asin, filepath, asin_set = set()):
-    asin_set.add(asin)
-    with open(filepath, "a") as file:
-        file.write(f"{asin}\n")
+# API credit budget (None is unlimited) and the pages/products it had no credits left for
+global budget
+budget = None
+deferred = {"pages": [], "products": []}
 
-def asin_loader(filepath = "asin_archive.txt"):
-    asin_set = set()
-    if os.path.exists(filepath):
-        with open(filepath, 'r') as file:
-            asins = file.readlines()
-            for line in asins:
-                asin_set.add(line.strip())
-    return asin_set
+# Resume switch: continue the interrupted run recorded in the job journals instead of starting fresh
+global resume
+resume = False
 
-def asin_handler(asin):
-    """Handle ASIN archival and return True if ASIN is unique and not see before"""
-    filepath = "asin_archive.txt"
-    if os.path.exists(filepath):
-        asin_set = asin_loader()
+# Delta mode switch and the snapshot ASINs / early stop state of every job
+global delta_mode
+delta_mode = False
+delta_state = {}
 
-        if is_unique_asin(asin, asin_set):
-            append_asin(asin, filepath, asin_set)
-            return True
-        else:
-            return False
+#Maximum number of product detail requests that can be in flight at once
+MAX_IN_FLIGHT = int(os.getenv("max_in_flight", "8"))
+
+#Number of search pages fetched at once and attempts per search page
+SEARCH_WORKERS = int(os.getenv("search_workers", "2"))
+SEARCH_ATTEMPTS = int(os.getenv("search_attempts", "3"))
+
+#Base URL of the scrapingdog API, point it at a local mock for benchmarks
+SCRAPINGDOG_BASE_URL = os.getenv("scrapingdog_base_url", "https://api.scrapingdog.com")
+
+#Pages and products left over when the credit budget runs out, fetched first by the next budgeted run
+BUDGET_QUEUE_PATH = os.getenv("budget_queue_path", "budget_queue.json")
+
+#Resume interrupted runs from their journals by default (same as --resume)
+JOURNAL_RESUME = os.getenv("journal_resume", "0") == "1"
+
+#Delta mode: refetch search pages, pass on only ASINs no earlier snapshot of the query has seen,
+#and stop paginating a query after search_delta_stop pages without anything new
+SEARCH_DELTA = os.getenv("search_delta", "0") == "1"
+DELTA_STOP_AFTER = int(os.getenv("search_delta_stop", "1"))
 
+def generate_uuid(name = None):
+    """Return a random UUID, or a stable one derived from name (e.g. an ASIN) so reruns reuse it."""
+    if name:
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"amazon-asin:{name}"))
+    return str(uuid.uuid4())
+
+def prompt_options():
+    """Terminal prompts for a single query run."""
+    global search_query, extractor, customizable
+    search_query = sys.argv[1]
+
+    extractor_prompt = input("Continue with scraping functionality or not (extraction functionality)? (y/n)")
+    extractor = False if extractor_prompt.lower() == "y" else True
+
+    if extractor is True:
+        customizable_opt_prompt = input("Allowing customization options containing products? (y/n)") 
+        customizable = True if customizable_opt_prompt.lower() == "y" else False
     else:
-        with open(filepath, "a"):
-            pass
-        append_asin(asin, filepath)
-        return True
+        customizable = True
+
+def default_job(page = 0):
+    """The job of an interactive run: the prompted query on amazon.com, pages 1-7 or a single page."""
+    return Job(search_query, "com", "us", range(1, 8) if page == 0 else range(page, page + 1))
+
+def get_journal(name = None):
+    """Return the journal of a job (default: the current search query), opening it on first use."""
+    name = sanitize_folder_name(name or search_query)
+    with counter_lock:
+        if name not in journals:
+            journals[name] = JobJournal(name)
+        return journals[name]
+
+def task_key(job, key):
+    return f"{job.name}|{key}"
+
+def asin_handler(asin, job = None):
+    """Handle ASIN archival and return True if ASIN is unique and not see before"""
+    if work_queue is None:
+        return get_asin_index().claim(asin)
+
+    # Worker mode: the queue decides which task owns the ASIN, the archive still records it
+    fresh = not get_asin_index().contains(asin)
+    if not work_queue.claim(asin, task_key(job, asin), fresh):
+        return False
+    get_asin_index().claim(asin)
+    return True
 
 def extract_urls(info):
     """Extract specific product URLs from the search results."""
@@ -83,7 +145,7 @@ def extract_urls(info):
         for product in products:
             product_url = product.get("optimized_url") 
             asin_code = product.get("asin")
-            product_uuid = generate_uuid()
+            product_uuid = generate_uuid(asin_code)
 
             if product_url:
                 file.write(product_url + '\n')
@@ -143,12 +205,12 @@ def sanitize_folder_name(name, chr_set='printable'):
 
     return result
 
-def create_product_directory(info):
+def create_product_directory(info, keyword = None):
     """SOURCE → SECTION → CATEGORY → ITEM NAME → COLOR → IMAGES"""
     directory_structure = {
         "Source": "Amazon",
         "Section": "Women",
-        "Keyword": search_query,
+        "Keyword": keyword or search_query,
         "Title": sanitize_folder_name(info.get("title"))
     }
 
@@ -168,126 +230,102 @@ def create_product_directory(info):
     
     return product_path
 
-def create_product_info_directory(query = search_query):
-    """products_info → {query} → {UUID}.json"""
-    info_path = os.path.join("products_info", query)
+def create_product_info_directory(query = None):
+    """products_info → {query} → segment-NNNNN.seg + index.ndjson (older runs: {UUID}.json)"""
+    info_path = os.path.join("products_info", query or search_query)
     os.makedirs(info_path, exist_ok = True)
     return info_path
 
 def extract_product_details_from_directory(folder_path):
-    """Extract JSON files that contains product details"""
+    """Lazily yield (info, uuid) for every product stored in folder_path.
+
+    Records come from the segment store first, then from legacy {UUID}.json files
+    which are parsed chunk by chunk in a worker pool.
+    """
     logging.debug(f"Attempting to extract JSON files from path: {folder_path}")
-    products = []
-    counter["total_product_json"] = len(os.listdir(folder_path))
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".json"):
-            file_path = os.path.join(folder_path, filename)
-            filename_without_extention = os.path.splitext(filename)[0]
-
-            with open(file_path, 'r') as file:
-                info = json.load(file)
-                product_uuid = filename_without_extention
-                products.append((info, product_uuid))
-
-            counter["extracted_product_json"] += 1
-            logging.debug(f"{counter["extracted_product_json"]}/{counter["total_product_json"]} JSON files has been extracted")
-            print(f"{counter["extracted_product_json"]}/{counter["total_product_json"]} JSON extracted.")
-    
+
+    if SegmentStore.exists(folder_path):
+        chunks = chunked(open_store(folder_path).iter_records(), LOAD_CHUNK_SIZE)
+        for chunk in chunks:
+            counter["extracted_product_json"] += len(chunk)
+            yield from ((info, product_uuid) for product_uuid, info in chunk)
+            logging.debug(f"{counter["extracted_product_json"]} records has been extracted from the segment store")
+
+    for chunk in iter_json_chunks(folder_path):
+        counter["extracted_product_json"] += len(chunk)
+        yield from chunk
+        logging.debug(f"{counter["extracted_product_json"]} JSON files has been extracted")
+        print(f"{counter["extracted_product_json"]} JSON extracted.")
+
     logging.info("JSON extraction completed")
     print("")
     print("JSON extraction completed")
     print("")
-    return products
-
-def extract_product_details(product_url, product_json_directory = ""):
-    """Extract product details for every product in the product_url list."""
-    logging.info("Individual product extraction begins...")
-    products = []
 
-    if not product_json_directory:
-        for product in product_url:
-            asin_code = product[1] 
-            product_uuid = product[2]
+def save_product_info(info, product_uuid, query = None):
+    """Append product details to the products_info/{query} segment store and return their location."""
+    info_folder_path = create_product_info_directory(query)
+    with metrics.timed("disk_write_seconds", target="product_info"):
+        entry = open_store(info_folder_path).put(product_uuid, info, asin=info.get("asin"))
+    return f"{info_folder_path}/segment-{entry['segment']:05d}.seg@{entry['offset']}"
 
-            if not asin_handler(asin_code): #if asin_handler is True, the asin code already exists in the archival
-                counter["existing_products"] += 1
+def extract_product_details(product_json_directory):
+    """Lazily yield (info, uuid) for every product already stored in product_json_directory."""
+    logging.info("Individual product extraction begins...")
+    return extract_product_details_from_directory(product_json_directory)
+
+def plan_image_jobs(info, product_uuid, keyword = None):
+    """Return the image folder and (product_uuid, image_url, image_path) jobs of a product."""
+    #Skip the info which contains multiple nested products through customization options
+    if info.get("customization_options").get("color") and not customizable: 
+        return None, []
+
+    # Order preserving dedup keeps image names stable between runs
+    image_url_list = list(dict.fromkeys(info.get("images", [])))
+    image_folder_path = create_product_directory(info, keyword)
+
+    jobs = []
+    for idx, image in enumerate(image_url_list):
+        image_name = f"{product_uuid}_{idx + 1}.jpg"
+        jobs.append((product_uuid, image, os.path.join(image_folder_path, image_name)))
+    return image_folder_path, jobs
+
+def extract_images(product_json_directory):
+    """Extract images of the products stored in product_json_directory."""
+    products = extract_product_details(product_json_directory)
+    image_folders = {}
+
+    def iter_product_jobs():
+        for product in products:
+            info, product_uuid = product[0], product[1]
+            image_folder_path, product_jobs = plan_image_jobs(info, product_uuid)
+            if image_folder_path is None:
                 continue
 
-            response = requests_api(asin_code, query="")
-            response.raise_for_status()
-            info = response.json() 
-            products.append((info, product_uuid))
-            info_folder_path = create_product_info_directory()
-            full_path = f"{info_folder_path}/{product_uuid}.json" 
-    
-            with open(full_path, "w") as file:
-                json.dump(info, file, indent=4)
-    
-            counter["extracted_products"] += 1
-            logging.debug(f"{counter['extracted_products']}/{counter['extracted_product_urls']} product urls has been extracted at {full_path}")
-            print(f"{counter['extracted_products']}/{counter['extracted_product_urls']} extracted")
-
-    
-        if counter["extracted_products"] != counter["extracted_product_urls"] - counter["existing_products"]:
-            missing_product_num = counter["extracted_product_urls"] - counter["extracted_products"]
-            logging.warning(f"Out of {counter['extracted_product_urls']}, number of missed products are: {missing_product_num}")
+            counter["total_image_urls"] += len(product_jobs)
+            image_folders[product_uuid] = image_folder_path
+            yield product_uuid, product_jobs
 
-        else:
-            logging.info("Product detail extraction completed.")
+    for index, (product_uuid, stats) in enumerate(download_images(iter_product_jobs())):
+        counter["extracted_images"] = stats["downloaded"]
+        counter["total_extracted_images"] += stats["downloaded"]
+        counter["existing_images"] += stats["existing"]
+        counter["failed_images"] += stats["failed"]
 
-        print("")
-        print("Product details extracted.")
-        print("")
-
-    else:
-        products = extract_product_details_from_directory(product_json_directory)
-        
-    return products 
-
-def extract_images(product_url = [], product_json_directory = ""):
-    """Extract images from the given product URLs."""
-    products = extract_product_details(product_url, product_json_directory)
-    for index, product in enumerate(products):
-        info, product_uuid = product[0], product[1]
-
-        #Skip the info which contains multiple nested products through customization options
-        if info.get("customization_options").get("color") and not customizable: 
-            continue 
-
-        image_url_list = list(set(info.get("images", [])))
-        counter["total_image_urls"] = len(image_url_list)
-        image_folder_path = create_product_directory(info)
-        counter["extracted_images"] = 0
-    
-        for idx, image in enumerate(image_url_list):
-            image_name = f"{product_uuid}_{idx + 1}.jpg"
-            image_path = os.path.join(image_folder_path, image_name)
-            if not os.path.exists(image_path):
-                response = requests.get(image)
-                response.raise_for_status()
-                if response.status_code == 200:
-                    image_path = os.path.join(image_folder_path, image_name)
-                    with open(image_path, "wb") as file:
-                        file.write(response.content)
-
-                    counter["extracted_images"] += 1
-                    counter["total_extracted_images"] += counter["extracted_images"]
-
-            else:
-               counter["existing_images"] += 1
-               logging.debug(f"Image already exists: {image_path}") 
-
-        logging.debug(f"{counter['extracted_images']}/{counter["total_image_urls"]} images are extracted for {index + 1}/{len(products)} products at path: {image_folder_path}")
+        logging.debug(f"{counter['extracted_images']}/{stats['total']} images are extracted for product {index + 1} at path: {image_folders.pop(product_uuid)}")
         logging.debug(f"Total extracted image count is: {counter["total_extracted_images"]} with existing image count of: {counter["existing_images"]}")
 
+    if counter["failed_images"]:
+        logging.warning(f"{counter['failed_images']} images could not be downloaded")
+        print(f"{counter['failed_images']} images could not be downloaded.")
     logging.info("Images extracted successfully")
     print("Images downloaded successfully.")
 
-def requests_api(asin_code, query, product=True, domain='com', country='us', page=1):
-    """Make API requests to fetch product or search data."""
+def requests_api(asin_code, query, product=True, domain='com', country='us', page=1, cache_mode=CACHE_MODE):
+    """Make API requests to fetch product or search data, cache_mode as in ResponseCache.cached_get."""
     api_key = os.getenv('scrapingdog_api')
-    search_url = "https://api.scrapingdog.com/amazon/search"
-    product_url = "https://api.scrapingdog.com/amazon/product"
+    search_url = f"{SCRAPINGDOG_BASE_URL}/amazon/search"
+    product_url = f"{SCRAPINGDOG_BASE_URL}/amazon/product"
   
     search_params = {
         "api_key": api_key,
@@ -304,11 +342,14 @@ def requests_api(asin_code, query, product=True, domain='com', country='us', pag
         "country": country
     }
 
+    cache = get_response_cache()
     if product:
-        response = requests.get(product_url, params=product_params)
+        with metrics.timed("api_call_seconds", endpoint="product"):
+            response = cache.cached_get(product_url, product_params, lambda: rate_limited_get(product_url, params=product_params), cache_mode)
         logging.debug(f"Trying to get response object for product: {asin_code}")
     else:
-        response = requests.get(search_url, params=search_params)
+        with metrics.timed("api_call_seconds", endpoint="search"):
+            response = cache.cached_get(search_url, search_params, lambda: rate_limited_get(search_url, params=search_params), cache_mode)
         logging.debug(f"Trying to get response object for search query: {query}")
 
     logging.debug(f"Got the respones with status code: {response.status_code}")
@@ -328,76 +369,444 @@ def logger_setup():
     logging.getLogger("urllib3").setLevel(logging.WARNING)
     logging.getLogger("requests").setLevel(logging.WARNING)
 
-def scrape_full_search(page = 0):
-    if page == 0:
-        counter["page"] = 1
-
-        while counter["page"] != 8:
-            logging.info(f"page: {counter['page']}")
-            print(f"page: {counter['page']}")
-    
-            logging.info("Initializing scraper...")
-            response = requests_api(query=search_query, product=False, asin_code="", page= counter["page"])
-
-            if response.status_code == 200:
-                info = response.json()
-                with open("page.json", "a") as file:
-                    json.dump(info, file, indent=4)
-                    file.write("\n")
-                print("Search response received.")
-            
-                try:
-                    product_url = extract_urls(info)
-                    extract_images(product_url)
-                except requests.exceptions.HTTPError as err:
-                    print(f"Error occurred: {err}")
-                    logging.exception("View the stack trace below to catch the issue.")
-                    logging.info("Trying again")
-                    continue
-
-            else:
-                print(f"Request failed with status code: {response.status_code}")
-                logging.info("Trying again")
-                continue
+def load_product_info(product_uuid, query = None):
+    """Read back product details stored by save_product_info."""
+    info_folder_path = create_product_info_directory(query)
+    info = open_store(info_folder_path).get(product_uuid)
+    if info is None:
+        with open(os.path.join(info_folder_path, f"{product_uuid}.json"), "r") as file:
+            info = json.load(file)
+    return info
+
+def reserve_credits(credits):
+    """Take the credits of an API call from the budget, False when they do not fit."""
+    return budget is None or budget.reserve(credits)
+
+def settle_credits(credits, response = None):
+    """Give back the credits of a call that failed or was answered from the response cache."""
+    if budget is None:
+        return
+    if response is None or response.status_code != 200 or response.headers.get("X-Cache") == "HIT":
+        budget.refund(credits)
+
+def search_page_path(job):
+    """search_pages → {job name} → segment store with the latest response of every page"""
+    return os.path.join("search_pages", sanitize_folder_name(job.name))
+
+def search_page_store(job):
+    return open_store(search_page_path(job))
+
+def get_delta_state(job):
+    """Delta mode: the ASINs of the job's last snapshot of every page, loaded on first use."""
+    with counter_lock:
+        state = delta_state.get(job.name)
+        if state is None:
+            known = set()
+            if SegmentStore.exists(search_page_path(job)):
+                for _, info in search_page_store(job).iter_records():
+                    known.update(result.get("asin") for result in info.get("results") or [])
+            state = delta_state[job.name] = {"known": known, "empty_pages": 0, "stopped": False}
+            logging.info(f"[{job.name}] delta mode, {len(known)} ASINs in earlier snapshots")
+        return state
+
+def filter_delta(job, page, products, previous):
+    """Delta mode: keep the products that are new since the snapshots, stop the job when a page has none."""
+    state = get_delta_state(job)
+    current = {asin_code for _, asin_code, _ in products}
+    before = {result.get("asin") for result in (previous or {}).get("results") or []}
+    with counter_lock:
+        new = [product for product in products if product[1] not in state["known"]]
+        state["known"].update(current)
+        if not new:
+            state["empty_pages"] += 1
+            if state["empty_pages"] >= DELTA_STOP_AFTER and not state["stopped"]:
+                state["stopped"] = True
+                logging.info(f"[{job.name}] nothing new on page {page}, stopping pagination")
+
+    logging.info(f"[{job.name}] page {page}: {len(new)} new, {len(current & before)} unchanged, {len(before - current)} gone since the last snapshot")
+    progress.add(job, "new_asins", len(new))
+    progress.add(job, "gone_asins", len(before - current))
+    return new
+
+def fetch_search_page(item):
+    """Search stage: fetch one (job, page) search page and yield its product URL tuples."""
+    job, page = item
+    journal = get_journal(job.name)
+    if delta_mode:
+        # Pages are always refetched, the snapshots decide what is new
+        if get_delta_state(job)["stopped"]:
+            progress.add(job, "skipped_pages")
+            return []
+    elif resume and journal.is_done("page", page):
+        pending = journal.pending("product", page=page)
+        logging.info(f"[{job.name}] page: {page} already done, resuming {len(pending)} unfinished products")
+        progress.page_done(job, page)
+        return [(*data["product"], page, job) for data in pending]
+
+    if not reserve_credits(SEARCH_CREDITS):
+        logging.info(f"[{job.name}] no credits left for page {page}, deferring it")
+        with counter_lock:
+            deferred["pages"].append([job_to_dict(job), page])
+        progress.add(job, "deferred_pages")
+        return []
+
+    for attempt in range(SEARCH_ATTEMPTS):
+        logging.info(f"[{job.name}] page: {page}")
+        print(f"[{job.name}] page: {page}")
 
-            counter["page"] += 1
-    
-            for key in list(counter.keys()):
-                if key == "page":
-                    continue
-                counter[key] = 0
-
-    else:
-        counter["page"] = page
-        logging.info(f"page: {counter['page']}")
-        print(f"page: {counter['page']}")
-    
         logging.info("Initializing scraper...")
-        response = requests_api(query=search_query, product=False, asin_code="", page= counter["page"])
+        # Delta mode compares against live results, a cached page would never show anything new
+        response = requests_api(query=job.query, product=False, asin_code="", domain=job.domain, country=job.country, page=page,
+                                cache_mode="refresh" if delta_mode else CACHE_MODE)
 
         if response.status_code == 200:
-            info = response.json()
-            with open("page.json", "a") as file:
-                json.dump(info, file, indent=4)
-                file.write("\n")
-            print("Search response received.")
-            
-            try:
-                product_url = extract_urls(info)
-                extract_images(product_url)
-            except requests.exceptions.HTTPError as err:
-                print(f"Error occurred: {err}")
-                logging.exception("View the stack trace below to catch the issue.")
-                return
+            break
 
+        print(f"Request failed with status code: {response.status_code}")
+        logging.info("Trying again")
+        time.sleep(backoff_delay(attempt, response.headers.get("Retry-After")))
+    else:
+        logging.error(f"Giving up on page {page} after {SEARCH_ATTEMPTS} attempts")
+        settle_credits(SEARCH_CREDITS, response)
+        journal.record("page", page, "failed", data={"page": page}, error=f"status code {response.status_code}")
+        progress.add(job, "failed_pages")
+        return []
+
+    settle_credits(SEARCH_CREDITS, response)
+    info = response.json()
+    previous = search_page_store(job).get(f"page-{page}") if delta_mode else None
+    search_page_store(job).put(f"page-{page}", info)
+    with counter_lock:
+        print("Search response received.")
+        products = extract_urls(info)
+    if delta_mode:
+        products = filter_delta(job, page, products, previous)
+
+    journal.record("page", page, "done")
+    progress.add(job, "product_urls", len(products))
+    progress.page_done(job, page)
+    return [(*product, page, job) for product in products]
+
+def count_existing_product(job):
+    with counter_lock:
+        counter["existing_products"] += 1
+    progress.add(job, "existing_products")
+
+def fetch_product_stage(product):
+    """Product stage: fetch and store details for a new ASIN and pass them on."""
+    product_url, asin_code, product_uuid, page, job = product
+    journal = get_journal(job.name)
+    data = {"product": [product_url, asin_code, product_uuid], "page": page}
+    status = journal.status("product", asin_code)
+    if status == "done":
+        return []
+    if status == "fetched":
+        return [(load_product_info(product_uuid, job.name), product_uuid, data, job)]
+
+    # Archived ASINs are skipped before any credits are reserved, so only new products get deferred.
+    # Worker mode leaves this to the queue's claim, which also answers retries of the claiming task
+    if status is None and work_queue is None and get_asin_index().contains(asin_code):
+        count_existing_product(job)
+        return []
+
+    # Reserve before the ASIN is claimed, so a deferred product is still new to the next run
+    if not reserve_credits(PRODUCT_CREDITS):
+        logging.info(f"[{job.name}] no credits left for product {asin_code}, deferring it")
+        with counter_lock:
+            deferred["products"].append([job_to_dict(job), product_url, asin_code, product_uuid, page])
+        progress.add(job, "deferred_products")
+        return []
+
+    if status is None:
+        if not asin_handler(asin_code, job): #if asin_handler is True, the asin code already exists in the archival
+            settle_credits(PRODUCT_CREDITS)
+            count_existing_product(job)
+            return []
+        journal.record("product", asin_code, "claimed", data=data)
+
+    response = None
+    try:
+        response = requests_api(asin_code, query="", domain=job.domain, country=job.country)
+        settle_credits(PRODUCT_CREDITS, response)
+        response.raise_for_status()
+        info = response.json()
+        full_path = save_product_info(info, product_uuid, job.name)
+    except (requests.exceptions.RequestException, ValueError, OSError) as err:
+        if response is None:
+            settle_credits(PRODUCT_CREDITS)
+        journal.record("product", asin_code, "failed", data=data, error=err)
+        progress.add(job, "failed_products")
+        raise
+    journal.record("product", asin_code, "fetched", data=data)
+    progress.add(job, "extracted_products")
+
+    with counter_lock:
+        counter["extracted_products"] += 1
+        logging.debug(f"{counter['extracted_products']}/{counter['extracted_product_urls']} product urls has been extracted at {full_path}")
+        print(f"{counter['extracted_products']}/{counter['extracted_product_urls']} extracted")
+    return [(info, product_uuid, data, job)]
+
+def download_journaled_image(job, product_uuid, image_url, image_path):
+    """Download one image and record the outcome, return 1 if it was downloaded."""
+    journal = get_journal(job.name)
+    key = f"{product_uuid}:{image_url}"
+    data = {"product_uuid": product_uuid, "image_url": image_url, "image_path": image_path}
+    try:
+        downloaded = download_image(image_url, image_path)
+    except (requests.exceptions.RequestException, OSError, InvalidImageError) as err:
+        logging.error(f"Failed to download {image_url}: {err}")
+        journal.record("image", key, "failed", data=data, error=err)
+        return None
+    journal.record("image", key, "done")
+    return int(downloaded)
+
+def download_images_stage(product):
+    """Image stage: download every image of one product."""
+    info, product_uuid, data, job = product
+    journal = get_journal(job.name)
+    image_folder_path, jobs = plan_image_jobs(info, product_uuid, job.name)
+    if image_folder_path is None:
+        journal.record("product", data["product"][1], "done", data=data)
+        return []
+
+    downloaded, failed = 0, 0
+    for _, image_url, image_path in jobs:
+        if journal.is_done("image", f"{product_uuid}:{image_url}"):
+            continue
+        result = download_journaled_image(job, product_uuid, image_url, image_path)
+        if result is None:
+            failed += 1
         else:
-            print(f"Request failed with status code: {response.status_code}")
-            return
+            downloaded += result
+
+    if not failed:
+        journal.record("product", data["product"][1], "done", data=data)
+    progress.add(job, "extracted_images", downloaded)
+    progress.add(job, "failed_images", failed)
+
+    with counter_lock:
+        counter["total_image_urls"] += len(jobs)
+        counter["total_extracted_images"] += downloaded
+        counter["existing_images"] += len(jobs) - downloaded - failed
+        counter["failed_images"] += failed
+        logging.debug(f"{downloaded}/{len(jobs)} images are extracted for product {product_uuid} at path: {image_folder_path}")
+        logging.debug(f"Total extracted image count is: {counter["total_extracted_images"]} with existing image count of: {counter["existing_images"]}")
+    return []
+
+def scrape_stages():
+    """Search → product → image stages of the scraping pipeline."""
+    return [
+        Stage("search", fetch_search_page, workers=SEARCH_WORKERS),
+        Stage("product", fetch_product_stage, workers=MAX_IN_FLIGHT),
+        Stage("images", download_images_stage, workers=IMAGE_WORKERS),
+    ]
+
+def search_scores(job, page):
+    """Priority of every ASIN on a stored search page."""
+    info = search_page_store(job).get(f"page-{page}") or {}
+    return {result.get("asin"): product_priority(result) for result in info.get("results") or []}
+
+def load_budget_queue(path = BUDGET_QUEUE_PATH):
+    if not os.path.exists(path):
+        return {"pages": [], "products": []}
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+def save_budget_queue(path = BUDGET_QUEUE_PATH):
+    """Persist the deferred pages and products, highest priority products first."""
+    with counter_lock:
+        pages = list({(json.dumps(job), page): [job, page] for job, page in deferred["pages"]}.values())
+        products = list({product[2]: product for product in deferred["products"]}.values())
+    scores = {}
+    for product in products:
+        job, page = job_from_dict(product[0]), product[4]
+        if (job.name, page) not in scores:
+            scores[(job.name, page)] = search_scores(job, page)
+        product.append(scores[(job.name, page)].get(product[2], 0.0))
+    products.sort(key=lambda product: product[-1], reverse=True)
+
+    if not pages and not products:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"pages": pages, "products": [product[:5] for product in products]}, file, indent=4)
+    logging.info(f"Budget exhausted, saved {len(pages)} pages and {len(products)} products to {path}")
+    print(f"Budget exhausted, {len(pages)} pages and {len(products)} products left in {path}")
+
+def run_budgeted(jobs):
+    """Spend the credit budget where it is worth most.
+
+    All search pages are fetched first (the products deferred by the last run lead), then
+    the found products are fetched best sellers, Amazon's choice and most reviewed first,
+    until the budget runs out. Whatever is left is saved to the budget queue.
+    """
+    queue = load_budget_queue()
+    deferred["pages"].clear()
+    deferred["products"].clear()
+
+    pages = [(job_from_dict(job), page) for job, page in queue["pages"]] + list(interleave_pages(jobs))
+    found = []
+    def collect(product):
+        found.append(product)
+        return []
+    stats = run_pipeline(list(dict.fromkeys(pages)), [Stage("search", fetch_search_page, workers=SEARCH_WORKERS), Stage("collect", collect)])
+
+    scores = {}
+    for product_url, asin_code, product_uuid, page, job in found:
+        if (job.name, page) not in scores:
+            scores[(job.name, page)] = search_scores(job, page)
+    found.sort(key=lambda product: scores[(product[4].name, product[3])].get(product[1], 0.0), reverse=True)
+    leftover = [(url, asin, uuid, page, job_from_dict(job)) for job, url, asin, uuid, page in queue["products"]]
+
+    products = list({product[1]: product for product in leftover + found}.values())
+    stats.update(run_pipeline(products, scrape_stages()[1:]))
+    save_budget_queue()
+    logging.info(f"Spent {budget.spent} API credits, {budget.remaining()} left")
+    print(f"Spent {budget.spent} API credits, {budget.remaining()} left")
+    return stats
+
+def plan_credits(jobs):
+    """Dry run: estimate the credits every job would spend, without calling the API."""
+    index = get_asin_index()
+    plan = {}
+    for job in jobs:
+        journal = get_journal(job.name)
+        pages = [page for page in job.pages if not (resume and journal.is_done("page", page))]
+
+        # Stored pages of earlier runs tell how many results a page has and how many are new
+        results, stored_pages = [], 0
+        if SegmentStore.exists(search_page_path(job)):
+            for _, info in search_page_store(job).iter_records():
+                stored_pages += 1
+                results.extend(result.get("asin") for result in info.get("results") or [])
+        per_page = len(results) / stored_pages if results else EXPECTED_PRODUCTS_PER_PAGE
+        new_share = sum(1 for asin in results if asin not in index) / len(results) if results else 1.0
+
+        pending = len(journal.pending("product")) if resume else 0
+        products = round(len(pages) * per_page * new_share) + pending
+        plan[job.name] = {
+            "pages": len(pages), "products": products,
+            "credits": len(pages) * SEARCH_CREDITS + products * PRODUCT_CREDITS
+        }
+
+    total = sum(entry["credits"] for entry in plan.values())
+    for name, entry in plan.items():
+        print(f"{name}: {entry['pages']} pages, ~{entry['products']} products, ~{entry['credits']} credits")
+    print(f"Total: ~{total} credits" + (f", budget {budget.remaining()} credits left" if budget is not None else ""))
+    return plan
+
+def start_journals(jobs):
+    """A fresh run sets the journals of earlier runs aside, a resumed run replays them."""
+    if resume:
+        return
+    for job in jobs:
+        get_journal(job.name).rotate()
+
+def finish_journals(jobs):
+    """Close the journal of every job that finished cleanly, so the next --resume does not skip its pages.
+
+    Journals with failed or unfinished items are kept for --resume and --retry-failed.
+    """
+    for job in jobs:
+        journal = get_journal(job.name)
+        if journal.is_finished():
+            journal.rotate()
+
+def run_jobs(jobs, results_path = None):
+    """Interleave the pages of every job through one shared pipeline, return per job results."""
+    global progress
+    progress = JobProgress(jobs)
+    start_journals(jobs)
+
+    if budget is not None:
+        stats = run_budgeted(jobs)
+    else:
+        pages = interleave_pages(jobs)
+        if delta_mode:
+            # Stop feeding the pages of jobs that ran out of new results
+            pages = (item for item in pages if not get_delta_state(item[0])["stopped"])
+        stats = run_pipeline(pages, scrape_stages())
+    logging.info(f"Pipeline stats: {dict(stats)}")
+    finish_journals(jobs)
+
+    if results_path:
+        progress.write(results_path)
+    return progress.results()
+
+def scrape_full_search(page = 0):
+    """Stream search pages → product details → images through bounded pipeline stages."""
+    run_jobs([default_job(page)])
 
     logging.info("Stopping scraper execution.")
     logging.info("\n")
     print("")
 
+def retry_dead_letters(job = None):
+    """Retry only the pages, products and images of a job that failed or were cut off in earlier runs."""
+    global progress
+    job = job or default_job()
+    progress = JobProgress([job])
+    journal = get_journal(job.name)
+    dead_letters = journal.dead_letters()
+    # Products an interrupted run left unfinished are claimed as well, no normal run fetches them again
+    interrupted = journal.pending("product")
+    logging.info(f"Retrying {len(dead_letters)} failed and {len(interrupted)} unfinished items")
+    print(f"Retrying {len(dead_letters)} failed and {len(interrupted)} unfinished items")
+
+    for entry in dead_letters:
+        if entry["kind"] == "image":
+            data = entry["data"]
+            download_journaled_image(job, data["product_uuid"], data["image_url"], data["image_path"])
+
+    products = [(*entry["data"]["product"], entry["data"]["page"], job) for entry in dead_letters if entry["kind"] == "product"]
+    products += [(*data["product"], data["page"], job) for data in interrupted]
+    if products:
+        run_pipeline(products, scrape_stages()[1:])
+
+    pages = [(job, entry["key"]) for entry in dead_letters if entry["kind"] == "page"]
+    if pages:
+        run_pipeline(pages, scrape_stages())
+
+    remaining = len(journal.dead_letters())
+    finish_journals([job])
+    logging.info(f"{remaining} items are still failing")
+    print(f"{remaining} items are still failing")
+
+def enqueue_jobs(jobs, queue):
+    """Seed the shared work queue with the search pages of every job."""
+    added = 0
+    for job, page in interleave_pages(jobs):
+        added += queue.put("page", task_key(job, page), {"job": job_to_dict(job), "page": page, "customizable": customizable})
+    logging.info(f"Enqueued {added} search pages")
+    return added
+
+def run_task(task):
+    """Worker mode: run the stage of one leased task and enqueue the tasks it produces."""
+    global customizable
+    payload = task.payload
+    customizable = payload.get("customizable", True)
+    job = job_from_dict(payload["job"])
+
+    if task.kind == "page":
+        for product_url, asin_code, product_uuid, page, _ in fetch_search_page((job, payload["page"])):
+            work_queue.put("product", task_key(job, asin_code), {**payload, "product": [product_url, asin_code, product_uuid], "page": page})
+    elif task.kind == "product":
+        for _ in fetch_product_stage((*payload["product"], payload["page"], job)):
+            work_queue.put("images", task.key, payload)
+    elif task.kind == "images":
+        product_uuid = payload["product"][2]
+        data = {"product": payload["product"], "page": payload["page"]}
+        download_images_stage((load_product_info(product_uuid, job.name), product_uuid, data, job))
+
+def worker_mode():
+    """Pull page/product/image tasks from the shared queue until it is drained."""
+    global work_queue, progress
+    work_queue = open_work_queue()
+    progress = JobProgress([])
+    stats = run_worker(work_queue, run_task)
+    print(json.dumps({"worker": dict(stats), "jobs": progress.results(), "queue": work_queue.counts()}, indent=4))
+
 def full_extraction():
     logging.info("Initializing extractor")
     try:
@@ -410,8 +819,48 @@ def full_extraction():
 if __name__ == "__main__":
     """Main execution block to fetch search results and extract images."""
     logger_setup()
-    print(f"For search query: {search_query}")
-    if extractor:
-        full_extraction()
-    else:
-        scrape_full_search()
+    # Live metrics on metrics_port and in the metrics_snapshot file while the run lasts
+    snapshot_path = f"metrics-{default_worker_id()}.json" if sys.argv[1] == "--worker" else METRICS_SNAPSHOT
+    with live_metrics(path=snapshot_path):
+        if sys.argv[1] == "--plan":
+            # Dry run of the credits a job file would spend: python scraping_automator.py --plan jobs.json
+            spec, jobs = load_jobs(sys.argv[2])
+            budget = open_budget(spec.get("budget"))
+            resume = spec.get("resume", JOURNAL_RESUME) or "--resume" in sys.argv
+            plan_credits(jobs)
+            sys.exit(0)
+
+        if sys.argv[1] == "--jobs":
+            # Headless batch mode: python scraping_automator.py --jobs jobs.json
+            spec, jobs = load_jobs(sys.argv[2])
+            customizable = spec.get("customizable", True)
+            budget = open_budget(spec.get("budget"))
+            delta_mode = spec.get("delta", SEARCH_DELTA)
+            resume = spec.get("resume", JOURNAL_RESUME) or "--resume" in sys.argv
+            results = run_jobs(jobs, results_path=spec.get("results", "job_results.json"))
+            print(json.dumps(results, indent=4))
+            sys.exit(0)
+
+        if sys.argv[1] == "--enqueue":
+            # Worker mode: seed the queue once, then start any number of --worker processes
+            spec, jobs = load_jobs(sys.argv[2])
+            customizable = spec.get("customizable", True)
+            enqueue_jobs(jobs, open_work_queue())
+            sys.exit(0)
+
+        if sys.argv[1] == "--worker":
+            worker_mode()
+            sys.exit(0)
+
+        prompt_options()
+        budget = open_budget()
+        delta_mode = SEARCH_DELTA or "--delta" in sys.argv
+        # Without --resume a run starts fresh, the journal of an interrupted run is set aside
+        resume = JOURNAL_RESUME or "--resume" in sys.argv
+        print(f"For search query: {search_query}")
+        if extractor:
+            full_extraction()
+        elif "--retry-failed" in sys.argv:
+            retry_dead_letters()
+        else:
+            scrape_full_search()
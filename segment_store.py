@@ -0,0 +1,202 @@
+import os
+import re
+import json
+import zlib
+import logging
+import threading
+from collections import Counter
+from file_lock import file_lock
+
+#Start a new segment file once the current one grows past this size
+SEGMENT_BYTES = int(float(os.getenv("segment_mb", "64")) * 1024 * 1024)
+
+#Number of records sampled to train the shared compression dictionary
+TRAIN_SAMPLES = int(os.getenv("segment_train_samples", "64"))
+
+# zlib only looks back 32KB, so a bigger dictionary is never used
+MAX_DICTIONARY_BYTES = 32 * 1024
+
+def train_dictionary(samples):
+    """Build a zlib preset dictionary from the JSON strings that recur across sample records."""
+    frequency = Counter()
+    for sample in samples:
+        frequency.update(set(re.findall(r'"(?:[^"\\]|\\.){0,200}"\s*:?\s*', sample)))
+
+    # zlib prefers matches close to the end, so the most valuable strings go last
+    common = [token for token, count in frequency.items() if count > 1]
+    common.sort(key=lambda token: frequency[token] * len(token))
+
+    dictionary, size = [], 0
+    for token in reversed(common):
+        encoded = token.encode("utf-8")
+        if size + len(encoded) > MAX_DICTIONARY_BYTES:
+            break
+        dictionary.append(encoded)
+        size += len(encoded)
+    return b"".join(reversed(dictionary))
+
+class SegmentStore:
+    """Append-only store of JSON records in compressed segment files with a key index.
+
+    Every record is one NDJSON line compressed on its own (with the shared dictionary once
+    it is trained) and appended to segment-NNNNN.seg. index.ndjson maps each key and ASIN
+    to (segment, offset, length) so any record can be read back without a scan.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.ndjson")
+        self.dictionary_path = os.path.join(directory, "dictionary.bin")
+        self.entries = {}
+        self.asins = {}
+        self.samples = []
+        self.dictionary = None
+        self.index_offset = 0
+        self._lock = threading.Lock()
+        with self._lock:
+            self._refresh()
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, "index.ndjson"))
+
+    def _refresh(self):
+        """Pick up the dictionary and the index lines written by other processes."""
+        if self.dictionary is None and os.path.exists(self.dictionary_path):
+            with open(self.dictionary_path, "rb") as file:
+                self.dictionary = file.read()
+
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as file:
+            file.seek(self.index_offset)
+            data = file.read()
+
+        complete = data.rfind(b"\n") + 1
+        for line in data[:complete].splitlines():
+            entry = json.loads(line)
+            self.entries[entry["key"]] = entry
+            if entry.get("asin"):
+                self.asins[entry["asin"]] = entry["key"]
+        self.index_offset += complete
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"segment-{segment:05d}.seg")
+
+    def _compress(self, raw):
+        if self.dictionary:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 15, zdict=self.dictionary)
+        else:
+            compressor = zlib.compressobj(6)
+        return compressor.compress(raw) + compressor.flush()
+
+    def _decompress(self, data, uses_dictionary):
+        if uses_dictionary:
+            decompressor = zlib.decompressobj(15, zdict=self.dictionary)
+        else:
+            decompressor = zlib.decompressobj()
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def _train(self):
+        self.dictionary = train_dictionary(self.samples)
+        self.samples = []
+        # Readers load the dictionary once, so it may only appear complete
+        temp_path = f"{self.dictionary_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(self.dictionary)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.dictionary_path)
+        logging.info(f"Trained a {len(self.dictionary)} byte compression dictionary for {self.directory}")
+
+    def put(self, key, record, asin = None):
+        """Append a record under key (and asin) and return its index entry."""
+        raw = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+
+        with self._lock, file_lock(self.index_path):
+            self._refresh()
+            if self.dictionary is None:
+                self.samples.append(raw.decode("utf-8"))
+                if len(self.samples) >= TRAIN_SAMPLES:
+                    self._train()
+
+            frame = self._compress(raw)
+            last = max((entry["segment"] for entry in self.entries.values()), default=1)
+            if os.path.exists(self._segment_path(last)) and os.path.getsize(self._segment_path(last)) + len(frame) > SEGMENT_BYTES:
+                last += 1
+
+            with open(self._segment_path(last), "ab") as file:
+                offset = file.tell()
+                file.write(frame)
+
+            entry = {
+                "key": key, "asin": asin, "segment": last, "offset": offset,
+                "length": len(frame), "dictionary": bool(self.dictionary)
+            }
+            with open(self.index_path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry) + "\n")
+            self._refresh()
+            return entry
+
+    def _read(self, entry):
+        with open(self._segment_path(entry["segment"]), "rb") as file:
+            file.seek(entry["offset"])
+            data = file.read(entry["length"])
+        return json.loads(self._decompress(data, entry["dictionary"]))
+
+    def get(self, key):
+        """Return the latest record stored under key, or None."""
+        with self._lock:
+            self._refresh()
+            entry = self.entries.get(key)
+        return self._read(entry) if entry else None
+
+    def get_by_asin(self, asin):
+        with self._lock:
+            self._refresh()
+            key = self.asins.get(asin)
+        return self.get(key) if key else None
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        with self._lock:
+            self._refresh()
+            return list(self.entries)
+
+    def iter_records(self):
+        """Yield (key, record) for the latest record of every key in segment order."""
+        with self._lock:
+            self._refresh()
+            entries = sorted(self.entries.values(), key=lambda entry: (entry["segment"], entry["offset"]))
+
+        segment, file = None, None
+        try:
+            for entry in entries:
+                if entry["segment"] != segment:
+                    if file:
+                        file.close()
+                    segment = entry["segment"]
+                    file = open(self._segment_path(segment), "rb")
+                file.seek(entry["offset"])
+                data = file.read(entry["length"])
+                yield entry["key"], json.loads(self._decompress(data, entry["dictionary"]))
+        finally:
+            if file:
+                file.close()
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def open_store(directory):
+    """Return the process-wide store for directory, opening it on first use."""
+    with _stores_lock:
+        key = os.path.abspath(directory)
+        if key not in _stores:
+            _stores[key] = SegmentStore(directory)
+        return _stores[key]
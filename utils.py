@@ -2,12 +2,19 @@ import os
 import shutil
 from datetime import datetime
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-def process_directory(base_dir, source_dir=None, threshold_day=18, remove_duplicates=False, remove_empty_folders=False, calculate_size=False):
+#Keyword folders processed at once by process_directory
+MAINTENANCE_WORKERS = int(os.getenv("maintenance_workers", "8"))
+
+def process_directory(base_dir, source_dir=None, threshold_day=18, remove_duplicates=False, remove_empty_folders=False, calculate_size=False, workers=MAINTENANCE_WORKERS):
     """
     Processes the specified directory by removing duplicates, counting items modified before a given threshold date, 
     and optionally removing empty folders.
 
+    Every requested operation is done in a single scandir walk over the tree, with the keyword
+    folders spread over a thread pool of the given number of workers.
+
     Parameters:
         base_dir (str): The base directory to process.
         source_dir (str, optional): The directory containing source files for duplicate removal. Defaults to None.
@@ -15,36 +22,52 @@ def process_directory(base_dir, source_dir=None, threshold_day=18, remove_duplic
         remove_duplicates (bool, optional): Whether to remove duplicate files. Defaults to False.
         remove_empty_folders (bool, optional): Whether to remove empty folders. Defaults to False.
         calculate_size (bool, optional): Whether to calculate the size of the directory. Defaults to False.
+        workers (int, optional): Keyword folders processed at once. Defaults to maintenance_workers (8).
 
     Returns:
         dict: A summary of the operations performed, including the total items removed, counted, directories removed, and total size.
     """
-    total_removed, total_items = 0, 0
-    counter = Counter({"total_removed_dirs": 0})
+    with os.scandir(base_dir) as scan:
+        folders = [entry for entry in scan if not entry.name.startswith('.') and entry.is_dir()]
+
+    # The DirEntry caches its stat, so every keyword folder is stat'ed once, before anything is removed
+    for folder in folders:
+        folder.stat()
 
-    # Remove duplicates
+    # Remove duplicates from the first 20 folders by modification time
+    dedupe_folders = set()
+    source_files = None
     if remove_duplicates and source_dir:
-        total_removed += remove_duplicates_from_directory(base_dir, source_dir)
+        source_files = set(os.listdir(source_dir))
+        dedupe_folders = {folder.path for folder in sorted(folders, key=lambda folder: folder.stat().st_mtime)[:20]}
 
     # Count items modified before the threshold date
+    count_before = None
     if not remove_duplicates:
-        total_items += count_items_before_threshold(base_dir, threshold_day)
+        count_before = datetime.now().replace(day=threshold_day).timestamp()
 
-    # Remove empty folders
-    if remove_empty_folders:
-        counter["total_removed_dirs"] += remove_empty_subdirectories(base_dir)
+    def scan(folder):
+        dedupe_files = source_files if folder.path in dedupe_folders else None
+        return scan_keyword_folder(folder, dedupe_files, count_before, remove_empty_folders, calculate_size)
 
-    # Calculate total size of the directory
-    total_size = 0
+    counter = Counter({"total_removed": 0, "total_items": 0, "total_removed_dirs": 0, "total_size": 0})
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for totals in pool.map(scan, folders):
+            counter.update(totals)
+
+    if count_before is not None:
+        print(f"Total items modified before the threshold date: {counter['total_items']}")
+    if remove_empty_folders:
+        print(f"Total number of removed directories: {counter['total_removed_dirs']}")
     if calculate_size:
-        total_size = calculate_directory_size(base_dir)
+        print(f"Total size of directory '{base_dir}': {counter['total_size'] / (1024 * 1024):.2f} MB")
 
     # Create summary
     summary = {
-        "total_removed": total_removed,
-        "total_items": total_items,
+        "total_removed": counter["total_removed"],
+        "total_items": counter["total_items"],
         "total_removed_dirs": counter["total_removed_dirs"],
-        "total_size": total_size
+        "total_size": counter["total_size"]
     }
 
     # Log summary
@@ -52,78 +75,72 @@ def process_directory(base_dir, source_dir=None, threshold_day=18, remove_duplic
 
     return summary
 
-def remove_duplicates_from_directory(base_dir, source_dir):
-    """Removes duplicate files from the target directory based on the source directory."""
-    total_removed = 0
-
-    # Get list of source files
-    source_files = set(os.listdir(source_dir))
-
-    # Get target folders and sort by modification time
-    target_folders = [
-        folder for folder in os.listdir(base_dir)
-        if not folder.startswith('.')
-    ]
-    target_folders.sort(key=lambda x: os.path.getmtime(os.path.join(base_dir, x)))
-
-    # Loop through the first 20 folders
-    for folder in target_folders[:20]:
-        folder_path = os.path.join(base_dir, folder)
-
-        # Process files in the current folder
-        with os.scandir(folder_path) as files_in_folder:
-            count = sum(
-                remove_file(file) for file in files_in_folder if file.name in source_files
-            )
-            total_removed += count
-            print(f"Total items removed from folder '{folder}': {count}\n")
-
-    return total_removed
-
-def count_items_before_threshold(base_dir, threshold_day):
-    """Counts items modified before the given threshold date."""
-    total_items = 0
-    current_date = datetime.now()
-
-    for folder in os.listdir(base_dir):
-        if folder.startswith('.'):
-            continue  # Skip hidden folders
-        folder_path = os.path.join(base_dir, folder)
-        if os.path.isdir(folder_path):
-            try:
-                mod_date = datetime.fromtimestamp(os.path.getmtime(folder_path))
-            except Exception as e:
-                print(f"Error accessing modification time for {folder}: {e}")
-                continue
-            
-            if mod_date <= current_date.replace(day=threshold_day):
-                try:
-                    total_items += len(os.listdir(folder_path))
-                except Exception as e:
-                    print(f"Error accessing folder contents for {folder}: {e}")
-                    continue
-    print(f"Total items modified before the threshold date: {total_items}")
-    return total_items
-
-def remove_empty_subdirectories(base_dir):
-    """Removes empty subdirectories."""
-    total_removed_dirs = 0
-    for folder in os.listdir(base_dir):
-        if folder.startswith('.'):
-            continue  # Skip hidden folders
-        folder_path = os.path.join(base_dir, folder)
-        for subfolder in os.listdir(folder_path):
-            image_dir = os.path.join(folder_path, subfolder, "Images")
+def scan_keyword_folder(folder, dedupe_files, count_before, remove_empty_folders, calculate_size):
+    """Does every requested operation on one keyword folder in a single pass and returns their totals.
+
+    folder is the DirEntry of the keyword folder. Entries named in dedupe_files are removed
+    (None removes nothing) and, when the folder was modified before the count_before
+    timestamp, its entries are counted.
+    """
+    totals = Counter()
+    try:
+        with os.scandir(folder.path) as scan:
+            entries = list(scan)
+    except OSError as e:
+        print(f"Error accessing folder contents for {folder.name}: {e}")
+        return totals
+
+    if dedupe_files is not None:
+        count = sum(remove_file(entry) for entry in entries if entry.name in dedupe_files)
+        totals["total_removed"] += count
+        print(f"Total items removed from folder '{folder.name}': {count}\n")
+        entries = [entry for entry in entries if entry.name not in dedupe_files or os.path.lexists(entry.path)]
+
+    if count_before is not None and folder.stat().st_mtime <= count_before:
+        totals["total_items"] += len(entries)
+
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+
+        if remove_empty_folders:
+            image_dir = os.path.join(entry.path, "Images")
             try:
-                if not os.listdir(image_dir):
+                with os.scandir(image_dir) as images:
+                    empty = next(images, None) is None
+                if empty:
                     os.removedirs(image_dir)
-                    total_removed_dirs += 1
+                    totals["total_removed_dirs"] += 1
                     print(f"Removing {image_dir}")
             except Exception as e:
                 print(f"Error accessing or removing {image_dir}: {e}")
-                continue
-    print(f"Total number of removed directories: {total_removed_dirs}")
-    return total_removed_dirs
+
+        if calculate_size:
+            totals["total_size"] += tree_size(entry.path)
+    return totals
+
+def tree_size(path):
+    """Total size of the files under path, like os.walk with os.path.getsize but with one stat per file."""
+    total_size = 0
+    pending = [path]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as scan:
+                entries = list(scan)
+        except OSError:
+            # os.walk skips unreadable or vanished directories the same way
+            continue
+        for entry in entries:
+            try:
+                # Symlinked directories are not followed, as in os.walk
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        pending.append(entry.path)
+                else:
+                    total_size += entry.stat().st_size
+            except OSError as e:
+                print(f"Error accessing {entry.path}: {e}")
+    return total_size
 
 def remove_file(file):
     try:
@@ -152,26 +169,6 @@ def log_summary(summary):
     print(f"Total size of directory: {summary['total_size'] / (1024 * 1024):.2f} MB")
     print("--- End of Summary ---\n")
 
-def calculate_directory_size(base_dir):
-    """Calculates the total size of the directory, including all files and subdirectories."""
-    total_size = 0
-    for folder in os.listdir(base_dir):
-        if folder.startswith('.'):
-            continue  # Skip hidden folders
-        folder_path = os.path.join(base_dir, folder)
-        for subfolder in os.listdir(folder_path):
-            subfolder_path = os.path.join(folder_path, subfolder)
-            try:
-                for dirpath, dirnames, filenames in os.walk(subfolder_path):
-                    for filename in filenames:
-                        file_path = os.path.join(dirpath, filename)
-                        total_size += os.path.getsize(file_path)
-            except Exception as e:
-                print(f"Error accessing {subfolder_path}: {e}")
-                continue
-    print(f"Total size of directory '{base_dir}': {total_size / (1024 * 1024):.2f} MB")
-    return total_size
-
 # Example of calling the function
 # result = process_directory("Amazon/Women", source_dir=r"C:\path\to\source\directory", remove_duplicates=True, remove_empty_folders=True, calculate_size=True)
 # print(result)
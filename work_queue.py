@@ -0,0 +1,363 @@
+import os
+import json
+import time
+import socket
+import logging
+import sqlite3
+import argparse
+import threading
+from collections import Counter, namedtuple
+
+#Shared work queue: a SQLite file on a shared filesystem, or redis://host:port/db for several machines
+WORK_QUEUE_URL = os.getenv("work_queue_url", "work_queue.sqlite")
+
+#SQLite journal mode of the queue file. WAL keeps its index in shared memory, which NFS/SMB
+#mounts do not share between machines, so only set WAL when every worker runs on one host
+WORK_QUEUE_JOURNAL_MODE = os.getenv("work_queue_journal_mode", "DELETE").upper()
+
+#Leases expire unless renewed by heartbeats, then another worker picks the task up
+LEASE_SECONDS = float(os.getenv("lease_seconds", "120"))
+HEARTBEAT_INTERVAL = float(os.getenv("heartbeat_interval", "30"))
+MAX_ATTEMPTS = int(os.getenv("task_attempts", "3"))
+WORKER_THREADS = int(os.getenv("worker_threads", "8"))
+POLL_INTERVAL = float(os.getenv("worker_poll_interval", "2"))
+
+# Deeper stages first, so products leave the queue before more pages fill it
+KIND_PRIORITY = {"images": 0, "product": 1, "page": 2}
+
+Task = namedtuple("Task", ["id", "kind", "key", "payload", "attempts"])
+
+class SqliteWorkQueue:
+    """Page, product and image tasks in one SQLite file shared by any number of worker processes.
+
+    Tasks are unique per (kind, key), so enqueueing the same work twice is a no-op. A leased
+    task belongs to one worker until its lease runs out; workers renew the leases of running
+    tasks with heartbeats, so only the tasks of crashed workers are handed out again.
+    SQLite needs working file locks, use the redis backend across machines without them.
+    The default DELETE journal works on a shared filesystem, WAL is for single-host queues.
+    """
+
+    def __init__(self, path = WORK_QUEUE_URL, journal_mode = WORK_QUEUE_JOURNAL_MODE):
+        if journal_mode not in ("DELETE", "TRUNCATE", "PERSIST", "WAL"):
+            raise ValueError(f"Unsupported work queue journal mode {journal_mode!r}")
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._connection.execute(f"PRAGMA journal_mode={journal_mode}")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT,
+                    key TEXT,
+                    payload TEXT,
+                    priority INTEGER,
+                    status TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    worker TEXT,
+                    lease_until REAL,
+                    error TEXT,
+                    updated REAL,
+                    UNIQUE (kind, key)
+                )
+            """)
+            self._connection.execute("CREATE INDEX IF NOT EXISTS tasks_ready ON tasks (status, priority, id)")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS claims (
+                    asin TEXT PRIMARY KEY,
+                    owner TEXT,
+                    fresh INTEGER,
+                    claimed REAL
+                )
+            """)
+
+    def _transaction(self, statements):
+        """Run statements(connection) inside one write transaction and return its result."""
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self._connection)
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+            return result
+
+    def put(self, kind, key, payload):
+        """Enqueue a task, return False if a task of this kind and key already exists."""
+        cursor = self._transaction(lambda connection: connection.execute(
+            "INSERT OR IGNORE INTO tasks (kind, key, payload, priority, status, updated) VALUES (?, ?, ?, ?, 'queued', ?)",
+            (kind, key, json.dumps(payload), KIND_PRIORITY.get(kind, len(KIND_PRIORITY)), time.time())
+        ))
+        return cursor.rowcount == 1
+
+    def lease(self, worker, lease_seconds = LEASE_SECONDS, max_attempts = MAX_ATTEMPTS):
+        """Hand the next ready task (new, or with an expired lease) to worker, or return None."""
+        def statements(connection):
+            now = time.time()
+            connection.execute(
+                "UPDATE tasks SET status = 'failed', error = 'lease expired', updated = ? "
+                "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, max_attempts)
+            )
+            row = connection.execute(
+                "SELECT id, kind, key, payload, attempts FROM tasks "
+                "WHERE status = 'queued' OR (status = 'leased' AND lease_until < ?) ORDER BY priority, id LIMIT 1", (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                (worker, now + lease_seconds, now, row[0])
+            )
+            return Task(row[0], row[1], row[2], json.loads(row[3]), row[4] + 1)
+        return self._transaction(statements)
+
+    def heartbeat(self, worker, task_ids, lease_seconds = LEASE_SECONDS):
+        """Extend the leases worker still holds on task_ids."""
+        now = time.time()
+        self._transaction(lambda connection: connection.executemany(
+            "UPDATE tasks SET lease_until = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+            [(now + lease_seconds, now, task_id, worker) for task_id in task_ids]
+        ))
+
+    def complete(self, task, worker):
+        cursor = self._transaction(lambda connection: connection.execute(
+            "UPDATE tasks SET status = 'done', updated = ? WHERE id = ? AND worker = ?", (time.time(), task.id, worker)
+        ))
+        if cursor.rowcount == 0:
+            logging.warning(f"Lease on {task.kind} {task.key} was lost before it completed")
+
+    def fail(self, task, worker, error, max_attempts = MAX_ATTEMPTS):
+        """Requeue a failed task, or mark it failed once it has used up its attempts."""
+        status = "failed" if task.attempts >= max_attempts else "queued"
+        self._transaction(lambda connection: connection.execute(
+            "UPDATE tasks SET status = ?, error = ?, updated = ? WHERE id = ? AND worker = ?",
+            (status, str(error), time.time(), task.id, worker)
+        ))
+
+    def claim(self, asin, owner, fresh):
+        """Claim an ASIN for owner exactly once across all workers.
+
+        The first claim stores whether the ASIN was new (fresh) and every later claim by the
+        same owner, e.g. the retry of a task whose worker crashed, gets that answer back.
+        Claims by any other owner return False.
+        """
+        def statements(connection):
+            connection.execute("INSERT OR IGNORE INTO claims VALUES (?, ?, ?, ?)", (asin, owner, int(fresh), time.time()))
+            return connection.execute("SELECT owner, fresh FROM claims WHERE asin = ?", (asin,)).fetchone()
+        claimed_by, claimed_fresh = self._transaction(statements)
+        return claimed_by == owner and bool(claimed_fresh)
+
+    def counts(self):
+        """Return {kind: {status: count}}."""
+        with self._lock:
+            rows = self._connection.execute("SELECT kind, status, COUNT(*) FROM tasks GROUP BY kind, status").fetchall()
+        counts = {}
+        for kind, status, count in rows:
+            counts.setdefault(kind, {})[status] = count
+        return counts
+
+    def is_drained(self):
+        """True when no task is queued or leased."""
+        with self._lock:
+            return self._connection.execute(
+                "SELECT 1 FROM tasks WHERE status IN ('queued', 'leased') LIMIT 1"
+            ).fetchone() is None
+
+# Pops the first task of the priority queues (KEYS[1..n]) and records its lease in the same
+# step, so a worker that dies halfway cannot take a task out of the queue without a lease on it.
+# The last five KEYS are the leases, owners, status, attempts and payloads; ARGV worker, deadline
+LEASE_SCRIPT = """
+local n = #KEYS
+local leases, owners, status, attempts, payloads = KEYS[n - 4], KEYS[n - 3], KEYS[n - 2], KEYS[n - 1], KEYS[n]
+for i = 1, n - 5 do
+    local task_id = redis.call("LPOP", KEYS[i])
+    if task_id then
+        redis.call("ZADD", leases, ARGV[2], task_id)
+        redis.call("HSET", owners, task_id, ARGV[1])
+        redis.call("HSET", status, task_id, "leased")
+        local attempt = redis.call("HINCRBY", attempts, task_id, 1)
+        return {task_id, attempt, redis.call("HGET", payloads, task_id)}
+    end
+end
+return false
+"""
+
+# Ends a lease and puts the task back in its queue (or marks it failed) in one step.
+# KEYS leases, owners, status, attempts, errors, queue; ARGV task_id, worker ("" for any),
+# error, max_attempts and LPUSH or RPUSH
+REQUEUE_SCRIPT = """
+if ARGV[2] ~= "" and redis.call("HGET", KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+if redis.call("ZREM", KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call("HSET", KEYS[5], ARGV[1], ARGV[3])
+if tonumber(redis.call("HGET", KEYS[4], ARGV[1]) or "0") >= tonumber(ARGV[4]) then
+    redis.call("HSET", KEYS[3], ARGV[1], "failed")
+else
+    redis.call("HSET", KEYS[3], ARGV[1], "queued")
+    redis.call(ARGV[5], KEYS[6], ARGV[1])
+end
+return 1
+"""
+
+class RedisWorkQueue:
+    """The work queue on a Redis compatible server, for workers on several machines.
+
+    client is any object with the redis-py API created with decode_responses=True, so a
+    local stand-in (e.g. fakeredis with lupa) can replace the server. Tasks wait in one list
+    per priority, leases are a sorted set scored by their deadline. Moving a task between a
+    queue and the leases runs as a Lua script, so a crash never leaves it in neither.
+    """
+
+    def __init__(self, client, prefix = "scraper"):
+        self.client = client
+        self.prefix = prefix
+        self._lease_script = client.register_script(LEASE_SCRIPT)
+        self._requeue_script = client.register_script(REQUEUE_SCRIPT)
+
+    def _name(self, *parts):
+        return ":".join((self.prefix, *map(str, parts)))
+
+    def _queue(self, kind):
+        return self._name("queue", KIND_PRIORITY.get(kind, len(KIND_PRIORITY)))
+
+    def _requeue(self, task_id, worker, error, max_attempts, push):
+        keys = [self._name(name) for name in ("leases", "owners", "status", "attempts", "errors")]
+        return self._requeue_script(keys=keys + [self._queue(task_id.split("|")[0])], args=[task_id, worker, error, max_attempts, push])
+
+    def put(self, kind, key, payload):
+        task_id = f"{kind}|{key}"
+        if not self.client.hsetnx(self._name("payloads"), task_id, json.dumps(payload)):
+            return False
+        self.client.hset(self._name("status"), task_id, "queued")
+        self.client.rpush(self._queue(kind), task_id)
+        return True
+
+    def _reclaim(self, max_attempts):
+        """Move tasks with expired leases back to the front of their queue (or to failed)."""
+        for task_id in self.client.zrangebyscore(self._name("leases"), 0, time.time()):
+            # Only the worker whose script removes the lease requeues the task
+            self._requeue(task_id, "", "lease expired", max_attempts, "LPUSH")
+
+    def lease(self, worker, lease_seconds = LEASE_SECONDS, max_attempts = MAX_ATTEMPTS):
+        self._reclaim(max_attempts)
+        queues = [self._name("queue", priority) for priority in sorted(set(KIND_PRIORITY.values())) + [len(KIND_PRIORITY)]]
+        keys = queues + [self._name(name) for name in ("leases", "owners", "status", "attempts", "payloads")]
+        leased = self._lease_script(keys=keys, args=[worker, time.time() + lease_seconds])
+        if not leased:
+            return None
+        task_id, attempts, payload = leased
+        kind, _, key = task_id.partition("|")
+        return Task(task_id, kind, key, json.loads(payload), int(attempts))
+
+    def heartbeat(self, worker, task_ids, lease_seconds = LEASE_SECONDS):
+        for task_id in task_ids:
+            if self.client.hget(self._name("owners"), task_id) == worker:
+                self.client.zadd(self._name("leases"), {task_id: time.time() + lease_seconds}, xx=True)
+
+    def complete(self, task, worker):
+        if self.client.hget(self._name("owners"), task.id) != worker:
+            logging.warning(f"Lease on {task.kind} {task.key} was lost before it completed")
+            return
+        with self.client.pipeline() as pipeline:
+            pipeline.zrem(self._name("leases"), task.id)
+            pipeline.hset(self._name("status"), task.id, "done")
+            pipeline.execute()
+
+    def fail(self, task, worker, error, max_attempts = MAX_ATTEMPTS):
+        self._requeue(task.id, worker, str(error), max_attempts, "RPUSH")
+
+    def claim(self, asin, owner, fresh):
+        self.client.set(self._name("claim", asin), json.dumps([owner, bool(fresh)]), nx=True)
+        claimed_by, claimed_fresh = json.loads(self.client.get(self._name("claim", asin)))
+        return claimed_by == owner and claimed_fresh
+
+    def counts(self):
+        counts = {}
+        for task_id, status in self.client.hgetall(self._name("status")).items():
+            kind = task_id.split("|")[0]
+            counts.setdefault(kind, Counter())[status] += 1
+        return {kind: dict(statuses) for kind, statuses in counts.items()}
+
+    def is_drained(self):
+        queued = sum(self.client.llen(self._name("queue", priority)) for priority in range(len(KIND_PRIORITY) + 1))
+        return queued == 0 and self.client.zcard(self._name("leases")) == 0
+
+def open_work_queue(url = WORK_QUEUE_URL):
+    """Open the queue at url: redis://... needs the redis package, anything else is a SQLite path."""
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The redis work queue backend requires the redis package (pip install redis)")
+        return RedisWorkQueue(redis.Redis.from_url(url, decode_responses=True))
+    return SqliteWorkQueue(url)
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def run_worker(queue, handler, worker_id = None, threads = WORKER_THREADS, poll_interval = POLL_INTERVAL):
+    """Run handler(task) on leased tasks in threads until the queue is drained, return the counts.
+
+    A handler that raises fails the task, which is requeued until it runs out of attempts.
+    """
+    worker_id = worker_id or default_worker_id()
+    held = set()
+    stats = Counter()
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            with lock:
+                task_ids = list(held)
+            if task_ids:
+                queue.heartbeat(worker_id, task_ids)
+
+    def loop():
+        while True:
+            task = queue.lease(worker_id)
+            if task is None:
+                if queue.is_drained():
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            with lock:
+                held.add(task.id)
+            try:
+                handler(task)
+            except Exception as e:
+                logging.exception(f"{task.kind} task {task.key} failed (attempt {task.attempts})")
+                queue.fail(task, worker_id, e)
+                with lock:
+                    stats[f"{task.kind}_failed"] += 1
+            else:
+                queue.complete(task, worker_id)
+                with lock:
+                    stats[f"{task.kind}_done"] += 1
+            finally:
+                with lock:
+                    held.discard(task.id)
+
+    logging.info(f"Worker {worker_id} starting with {threads} threads")
+    heartbeat_thread = threading.Thread(target=heartbeat, name="heartbeat", daemon=True)
+    heartbeat_thread.start()
+    workers = [threading.Thread(target=loop, name=f"worker-{number}") for number in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    stop.set()
+
+    logging.info(f"Worker {worker_id} finished: {dict(stats)}")
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the task counts of the shared work queue.")
+    parser.add_argument("--url", default=WORK_QUEUE_URL, help="SQLite path or redis:// URL")
+    args = parser.parse_args()
+
+    print(json.dumps(open_work_queue(args.url).counts(), indent=4))